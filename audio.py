@@ -0,0 +1,147 @@
+import numpy as np
+import tensorflow as tf
+import librosa
+from scipy.io import wavfile
+
+
+_mel_basis = {}
+_windows = {}
+
+
+def mel_basis(hparams):
+    """Mel filterbank used by librosa.feature.melspectrogram, built once per configuration."""
+    key = (hparams.sample_rate, hparams.n_fft, hparams.num_mels, hparams.fmin, hparams.fmax)
+    if key not in _mel_basis:
+        _mel_basis[key] = librosa.filters.mel(hparams.sample_rate, hparams.n_fft, n_mels=hparams.num_mels,
+                                              fmin=hparams.fmin, fmax=hparams.fmax).astype(np.float32)
+    return _mel_basis[key]
+
+
+def stft_window(hparams):
+    """Periodic Hann window of n_fft samples, the window librosa.stft uses by default."""
+    if hparams.n_fft not in _windows:
+        n = np.arange(hparams.n_fft)
+        _windows[hparams.n_fft] = (0.5 - 0.5 * np.cos(2 * np.pi * n / hparams.n_fft)).astype(np.float32)
+    return _windows[hparams.n_fft]
+
+
+def load_wav(path, sr):
+    """Reads an audio file as mono float32 at `sr` Hz, only resampling when its rate differs.
+
+    PCM wavs are read with scipy and scaled like librosa.load does, other files fall back
+    to librosa.load.
+    """
+    try:
+        rate, wav = wavfile.read(path)
+    except ValueError:
+        return librosa.load(path, sr=sr)[0]
+
+    if wav.dtype == np.uint8:
+        wav = (wav.astype(np.float32) - 128) / 128.
+    elif np.issubdtype(wav.dtype, np.integer):
+        wav = wav.astype(np.float32) / float(np.iinfo(wav.dtype).max + 1)
+    else:
+        wav = wav.astype(np.float32)
+
+    if wav.ndim > 1:
+        wav = wav.mean(axis=1)
+    if rate != sr:
+        wav = librosa.resample(wav, rate, sr).astype(np.float32)
+    return wav
+
+
+def stft_context(hparams):
+    """Samples of context the STFT needs on both sides of a window (librosa's center=True padding)."""
+    return hparams.n_fft // 2
+
+
+def pad_context(audio, hparams):
+    return np.pad(audio, stft_context(hparams), mode='reflect')
+
+
+def frame_padding(length, hparams):
+    """Zeros added before and after a wav of `length` samples so that the training audio covers
+    the length // hop_size + 1 centered frames of its mel."""
+    pad = (length // hparams.hop_size + 1) * hparams.hop_size - length
+    return pad // 2, pad // 2 + pad % 2
+
+
+def context_window(wav, begin, end, hparams):
+    """Rows begin:end of audio_with_context(wav, hparams), only reading the samples they need
+    (`wav` can be memory-mapped)."""
+    n = wav.shape[0]
+    context = stft_context(hparams)
+    rows = np.arange(begin, end)
+
+    # The wav reflected at its ends like pad_context does, zeros after it
+    index = np.abs(rows - context)
+    index = np.clip(np.where(index >= n, 2 * (n - 1) - index, index), 0, n - 1)
+    return np.where(rows < n + 2 * context, wav[index], 0.).astype(np.float32)
+
+
+def wav_bounds(length, hparams):
+    """(wav_start, wav_end, pad_l) of a wav of `length` samples in audio_with_context: the rows
+    holding the wav itself and the zeros frame_padding adds before it in the training audio."""
+    context = stft_context(hparams)
+    return context, context + length, frame_padding(length, hparams)[0]
+
+
+def audio_with_context(wav, hparams, min_frames=0):
+    """An unpadded wav for mel_on_the_fly, reflect padded by stft_context like melspectrogram pads it.
+
+    The STFT window of frame t starts at row t * hop_size. The training audio, the wav zero padded
+    by frame_padding, is cut out of the same rows by tf_training_audio. Clips shorter than
+    `min_frames` frames are padded with zeros.
+    """
+    n_frames = max(wav.shape[0] // hparams.hop_size + 1, min_frames)
+    return context_window(wav, 0, n_frames * hparams.hop_size + 2 * stft_context(hparams), hparams)
+
+
+def normalize(mel, hparams):
+    mel = 20 * np.log10(np.maximum(1e-4, mel)) - hparams.ref_level_db
+    return np.clip((mel - hparams.min_level_db) / (-hparams.min_level_db), 0, 1)
+
+
+def melspectrogram(wav, hparams):
+    """Normalized log-mel of a wav, the same as librosa.feature.melspectrogram followed by normalize.
+
+    All frames of the utterance are windowed and transformed at once.
+    """
+    audio = pad_context(wav.astype(np.float32), hparams)
+    n_frames = 1 + (audio.shape[0] - hparams.n_fft) // hparams.hop_size
+    frames = np.lib.stride_tricks.as_strided(audio, shape=(n_frames, hparams.n_fft),
+                                             strides=(audio.strides[0] * hparams.hop_size, audio.strides[0]))
+
+    spectrum = np.fft.rfft(frames * stft_window(hparams), axis=-1)
+    power = spectrum.real ** 2 + spectrum.imag ** 2
+    return normalize(power.dot(mel_basis(hparams).T), hparams)
+
+
+def tf_melspectrogram(audio, hparams):
+    """Normalized log-mel of a 1-D float32 tensor, as computed by melspectrogram.
+
+    `audio` has to include stft_context(hparams) samples on both sides, frame t is
+    centered on sample t * hop_size of the signal without the context.
+    """
+    stft = tf.contrib.signal.stft(audio, frame_length=hparams.n_fft, frame_step=hparams.hop_size,
+                                  fft_length=hparams.n_fft, window_fn=tf.contrib.signal.hann_window)
+    power = tf.square(tf.real(stft)) + tf.square(tf.imag(stft))
+    mel = tf.matmul(power, tf.constant(mel_basis(hparams).T))
+
+    mel = 20 * tf.log(tf.maximum(1e-4, mel)) / np.log(10) - hparams.ref_level_db
+    return tf.clip_by_value((mel - hparams.min_level_db) / (-hparams.min_level_db), 0, 1)
+
+
+def tf_training_audio(audio, frame, n_samples, bounds, hparams):
+    """`n_samples` of training audio from frame `frame` on, cut out of a [rows, 1] tensor of
+    audio_with_context rows.
+
+    The training audio is the wav zero padded by frame_padding, the audio preprocessing stores
+    without mel_on_the_fly. `bounds` are the (wav_start, wav_end, pad_l) of wav_bounds, counted
+    from the first row of `audio`.
+    """
+    wav_start, wav_end, pad_l = bounds
+    begin = frame * hparams.hop_size + stft_context(hparams) - pad_l
+    rows = tf.range(begin, begin + n_samples)
+    inside = tf.logical_and(rows >= wav_start, rows < wav_end)
+    return audio[begin:begin + n_samples] * tf.cast(inside, audio.dtype)[:, tf.newaxis]
@@ -0,0 +1,588 @@
+import tensorflow as tf
+import numpy as np
+import time
+import argparse
+import os
+import tempfile
+import sys
+import shutil
+import librosa
+from scipy.io import wavfile
+from hparams import hparams
+from model import FloWaveNet, block_costs, partition_blocks
+from modules import WaveNet
+from utils import fp16_dtype_getter, average_gradients, all_reduce_gradients, jit_config
+from dataset import Dataset, NumpyDataset
+from tfrecord import TFRecordCreator
+from audio import tf_melspectrogram, tf_training_audio, pad_context, normalize, load_wav, melspectrogram, audio_with_context, context_window, wav_bounds
+from preprocessing import _process_utterance
+
+
+def randomize_variables(sess, stddev=0.05):
+    # Freshly initialized ZeroConv1d layers output zeros, random weights exercise the whole graph.
+    for v in tf.global_variables():
+        sess.run(v.assign(np.random.normal(scale=stddev, size=v.shape.as_list()).astype(v.dtype.as_numpy_dtype)))
+
+
+def time_run(sess, fetches, feed_dict, runs):
+    sess.run(fetches, feed_dict=feed_dict)
+    start_time = time.time()
+    for _ in range(runs):
+        result = sess.run(fetches, feed_dict=feed_dict)
+    return (time.time() - start_time) / runs, result
+
+
+def peak_memory(sess, fetches, feed_dict):
+    """Largest amount of memory in use by any allocator during one run, in bytes."""
+    run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+    run_metadata = tf.RunMetadata()
+    sess.run(fetches, feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
+
+    peak = 0
+    for device_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in device_stats.node_stats:
+            for memory in node_stats.memory:
+                peak = max(peak, memory.allocator_bytes_in_use, memory.peak_bytes)
+    return peak
+
+
+def device_busy_times(sess, fetches, feed_dict):
+    """Wall time of one traced run and the time every device spent running ops, in seconds."""
+    run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+    run_metadata = tf.RunMetadata()
+    sess.run(fetches, feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
+
+    busy = {}
+    start, end = float('inf'), 0
+    for device_stats in run_metadata.step_stats.dev_stats:
+        intervals = sorted((n.all_start_micros, n.all_start_micros + n.all_end_rel_micros) for n in device_stats.node_stats)
+        total, last = 0, 0
+        for op_start, op_end in intervals:
+            # Ops of a device overlap on the inter-op threads, only the union counts
+            total += max(0, op_end - max(op_start, last))
+            last = max(last, op_end)
+        if intervals:
+            busy[device_stats.device] = total / 1e6
+            start, end = min(start, intervals[0][0]), max(end, last)
+    return (end - start) / 1e6, busy
+
+
+def build_train_step(hparams, x, c, scope='vocoder'):
+    """Loss, ActNorm init placeholder and Adam step of a FloWaveNet, as train.build_model builds them for one tower."""
+    init = tf.placeholder_with_default(False, shape=None)
+    with tf.variable_scope(scope, reuse=tf.AUTO_REUSE, custom_getter=fp16_dtype_getter):
+        model = FloWaveNet(hparams, init=init)
+        log_p, logdet = model.forward(x, c)
+        loss = -(log_p + logdet)
+
+    variables = tf.trainable_variables(scope)
+    grads = tf.gradients(tf.scalar_mul(hparams.scale, loss), variables)
+    grad_vars = [(tf.scalar_mul(1. / hparams.scale, g), v) for g, v in zip(grads, variables) if g is not None]
+    with tf.variable_scope(scope + '_optimizer'):
+        train_op = tf.train.AdamOptimizer(0.001).apply_gradients(grad_vars)
+    return loss, init, train_op
+
+
+def random_batch(args, hparams, frames=None):
+    frames = args.frames if frames is None else frames
+    audio = np.random.uniform(-0.5, 0.5, size=[args.batch_size, frames * hparams.hop_size, 1])
+    mel = np.random.uniform(size=[args.batch_size, frames, hparams.num_mels])
+    return audio.astype(np.float32), mel.astype(np.float32)
+
+
+def memory_scaling(args, hparams, settings):
+    """Measures a training step at growing crop lengths for every (name, hparams overrides) in `settings`
+    and extrapolates the longest crop that fits into --memory_budget."""
+    defaults = dict((name, hparams.get(name)) for _, overrides in settings for name in overrides)
+    frames_list = [args.frames * 2 ** i for i in range(args.sizes)]
+
+    for name, overrides in settings:
+        hparams.override_from_dict(defaults)
+        hparams.override_from_dict(overrides)
+
+        memories = []
+        for frames in frames_list:
+            audio, mel = random_batch(args, hparams, frames)
+            with tf.Graph().as_default():
+                x = tf.placeholder(tf.float32, shape=[None, None, 1])
+                c = tf.placeholder(tf.float32, shape=[None, None, hparams.num_mels])
+                _, init, train_op = build_train_step(hparams, x, c)
+
+                with tf.Session() as sess:
+                    sess.run(tf.global_variables_initializer())
+                    feed_dict = {x: audio, c: mel}
+                    sess.run(train_op, feed_dict={x: audio, c: mel, init: True})
+                    duration, _ = time_run(sess, train_op, feed_dict, args.runs)
+                    memories.append(peak_memory(sess, train_op, feed_dict))
+
+            print('{}: batch {} x {} samples, {:.3f} sec/step, peak memory {:.1f} MB'.format(
+                name, args.batch_size, frames * hparams.hop_size, duration, memories[-1] / 2 ** 20))
+
+        if len(frames_list) > 1:
+            per_frame = (memories[-1] - memories[0]) / float(frames_list[-1] - frames_list[0])
+            fixed = memories[0] - per_frame * frames_list[0]
+            max_frames = int((args.memory_budget * 2 ** 20 - fixed) / per_frame) if per_frame > 0 else float('inf')
+            print('{}: ~{:.1f} KB per frame, longest crop within {} MB ~{} samples per batch item'.format(
+                name, per_frame / 2 ** 10, args.memory_budget, max_frames * hparams.hop_size))
+
+    hparams.override_from_dict(defaults)
+
+
+def fused_reverse(args, hparams):
+    """Compares FloWaveNet.reverse with and without ActNorm merged into the couplings."""
+    with tf.variable_scope('vocoder', reuse=tf.AUTO_REUSE, custom_getter=fp16_dtype_getter):
+        lc = tf.placeholder(tf.float32, shape=[None, None, hparams.num_mels])
+        z = tf.placeholder(tf.float32, shape=[None, None, 1])
+        model = FloWaveNet(hparams)
+        predictions = model.reverse(z, lc)
+        fused_predictions = model.reverse(z, lc, fused=True)
+
+    feed_dict = {
+        lc: np.random.uniform(size=[args.batch_size, args.frames, hparams.num_mels]),
+        z: np.random.normal(size=[args.batch_size, args.frames * hparams.hop_size, 1]) * hparams.temp
+    }
+
+    with tf.Session() as sess:
+        randomize_variables(sess)
+        duration, result = time_run(sess, predictions, feed_dict, args.runs)
+        fused_duration, fused_result = time_run(sess, fused_predictions, feed_dict, args.runs)
+
+    print('reverse:       {:.3f} sec'.format(duration))
+    print('fused reverse: {:.3f} sec'.format(fused_duration))
+    print('max abs difference: {:.3e}'.format(np.max(np.abs(result - fused_result))))
+
+
+def shared_conditioning(args, hparams):
+    """Times the WaveNet of every Block with per-ResBlock and shared conditioning projections."""
+    for k in range(hparams.n_block):
+        in_channels = 2 ** k
+        cin_channels = hparams.num_mels * 2 ** k
+        time_steps = args.frames * hparams.hop_size // 2 ** (k + 1)
+
+        feed_dict = {}
+        durations = []
+        with tf.Graph().as_default():
+            x = tf.placeholder(tf.float32, shape=[None, None, in_channels])
+            c = tf.placeholder(tf.float32, shape=[None, None, cin_channels])
+            feed_dict[x] = np.random.normal(size=[args.batch_size, time_steps, in_channels])
+            feed_dict[c] = np.random.uniform(size=[args.batch_size, time_steps, cin_channels])
+
+            outputs = []
+            for shared in [False, True]:
+                net = WaveNet(in_channels=in_channels, out_channels=2 * in_channels, num_layers=hparams.n_layer,
+                              cin_channels=cin_channels, causal=hparams.causality, fused_gate=hparams.fused_gate,
+                              shared_conditioning=shared, scope='WaveNet_%s' % ('shared' if shared else 'per_layer'))
+                outputs.append(net(x, c))
+
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                for output in outputs:
+                    durations.append(time_run(sess, output, feed_dict, args.runs)[0])
+
+        print('Block {}: {} conditioning channels, {} time steps, per-ResBlock: {:.4f} sec, shared: {:.4f} sec'.format(
+            k, cin_channels, time_steps, durations[0], durations[1]))
+
+
+def cin_bottleneck(args, hparams):
+    """Compares training steps with the doubling conditioning and with hparams.cin_bottleneck (default 256)."""
+    bottleneck = hparams.cin_bottleneck if hparams.cin_bottleneck > 0 else 256
+    audio, mel = random_batch(args, hparams)
+
+    for cin_bottleneck in [0, bottleneck]:
+        hparams.set_hparam('cin_bottleneck', cin_bottleneck)
+        with tf.Graph().as_default():
+            x = tf.placeholder(tf.float32, shape=[None, None, 1])
+            c = tf.placeholder(tf.float32, shape=[None, None, hparams.num_mels])
+            loss, init, train_op = build_train_step(hparams, x, c)
+            n_params = sum(np.prod(v.shape.as_list()) for v in tf.trainable_variables())
+
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                feed_dict = {x: audio, c: mel}
+                sess.run(train_op, feed_dict={x: audio, c: mel, init: True})
+                duration, _ = time_run(sess, train_op, feed_dict, args.runs)
+                memory = peak_memory(sess, train_op, feed_dict)
+
+                # A quick likelihood comparison: both variants fit the same batch for the same number of steps
+                for _ in range(args.steps):
+                    sess.run(train_op, feed_dict=feed_dict)
+                final_loss = sess.run(loss, feed_dict=feed_dict)
+
+        print('cin_bottleneck={}: {} parameters, {:.3f} sec/step, peak memory {:.1f} MB, final loss {:.5f}'.format(
+            cin_bottleneck, n_params, duration, memory / 2 ** 20, final_loss))
+
+
+def reversible(args, hparams):
+    """Memory and time of a training step with stored activations and with reversible backprop."""
+    memory_scaling(args, hparams, [('stored activations', {'reversible': False}),
+                                   ('reversible', {'reversible': True})])
+
+
+def checkpointing(args, hparams):
+    """Memory/compute trade-off of checkpointing every N flows."""
+    settings = [('no checkpointing', {'checkpoint_flows': 0, 'reversible': False})]
+    for n in sorted(set([1, 2, max(hparams.n_flow // 2, 1), hparams.n_flow])):
+        settings.append(('checkpoint every {} flows'.format(n), {'checkpoint_flows': n, 'reversible': False}))
+    memory_scaling(args, hparams, settings)
+
+
+def tfrecord_parse(args, hparams):
+    """Input pipeline throughput for FloatList (version 1) and raw-bytes (version 2) records."""
+    frames = max(args.frames, 4 * (hparams.max_time_steps // hparams.hop_size))
+    utterances = [(np.random.uniform(-0.5, 0.5, size=frames * hparams.hop_size).astype(np.float32),
+                   np.random.uniform(size=[frames, hparams.num_mels]).astype(np.float32)) for _ in range(args.records)]
+    defaults = dict(tfrecord_version=hparams.tfrecord_version, tfrecord_pcm16=hparams.tfrecord_pcm16)
+    temp_dir = tempfile.mkdtemp()
+
+    for name, version, pcm16 in [('FloatList', 1, False), ('raw float32', 2, False), ('raw int16', 2, True)]:
+        hparams.override_from_dict(dict(tfrecord_version=version, tfrecord_pcm16=pcm16))
+        creator = TFRecordCreator(os.path.join(temp_dir, 'train.txt'), hparams)
+        filename = os.path.join(temp_dir, 'v{}_{}.tfrecord'.format(version, int(pcm16)))
+        options = tf.python_io.TFRecordOptions(hparams.tfrecord_compression)
+        with tf.python_io.TFRecordWriter(filename, options=options) as tfwriter:
+            for audio, mel in utterances:
+                tfwriter.write(creator._get_example(audio, mel).SerializeToString())
+
+        with tf.Graph().as_default():
+            dataset = Dataset(filename, filename, hparams)
+            with tf.Session() as sess:
+                dataset.initialize(sess)
+                duration, _ = time_run(sess, dataset.inputs[0], None, args.runs)
+
+        print('{}: {:.1f} MB on disk, {:.2f} ms/batch, {:.1f} examples/sec'.format(
+            name, os.path.getsize(filename) / 2 ** 20, duration * 1000, hparams.batch_size / duration))
+        os.remove(filename)
+
+    hparams.override_from_dict(defaults)
+    os.rmdir(temp_dir)
+
+
+def input_pipeline(args, hparams):
+    """Examples/sec the training input pipeline delivers on its own, without a model consuming the batches."""
+    if hparams.dataset_backend == 'numpy':
+        dataset = NumpyDataset(os.path.join(args.data_dir, 'train.txt'), hparams)
+    else:
+        train_tfrecord = os.path.join(args.data_dir, 'train-*-of-*.tfrecord')
+        dataset = Dataset(train_tfrecord, train_tfrecord, hparams)
+    batch = [dataset.local_conditions[0], dataset.inputs[0]]
+
+    with tf.Session() as sess:
+        dataset.initialize(sess)
+        # The first batches fill the shuffle buffer and let autotuning settle
+        for _ in range(args.runs):
+            sess.run(batch)
+
+        start_time = time.time()
+        for _ in range(args.batches):
+            sess.run(batch)
+        duration = time.time() - start_time
+
+    examples_per_sec = args.batches * hparams.batch_size / duration
+    print('{} batches of {} in {:.2f} sec: {:.1f} examples/sec, {:.1f} sec of audio/sec'.format(
+        args.batches, hparams.batch_size, duration, examples_per_sec, examples_per_sec * hparams.max_time_steps / hparams.sample_rate))
+
+
+def librosa_melspectrogram(wav, hparams):
+    """The mel of preprocessing.py before audio.melspectrogram, for parity checks and timings."""
+    mel_spectrogram = librosa.feature.melspectrogram(wav, sr=hparams.sample_rate, n_fft=hparams.n_fft,
+                                                     hop_length=hparams.hop_size, n_mels=hparams.num_mels,
+                                                     fmin=hparams.fmin, fmax=hparams.fmax).T
+    return normalize(mel_spectrogram, hparams)
+
+
+def synthetic_wav(args, hparams):
+    t = np.arange(args.frames * 8 * hparams.hop_size) / float(hparams.sample_rate)
+    wav = 0.5 * np.sin(2 * np.pi * 440 * t) + np.random.uniform(-0.1, 0.1, size=t.shape)
+    return wav.astype(np.float32)
+
+
+def mel_parity(args, hparams):
+    """Compares the tf mel of the input pipeline (mel_on_the_fly) with the librosa mel, and the mel
+    and training audio the pipeline gets from the audio preprocessing stores with the ones stored
+    without mel_on_the_fly. Exits with an error if any difference exceeds --tolerance."""
+    if args.wav:
+        wav, _ = librosa.load(args.wav, sr=hparams.sample_rate)
+        wav = (wav / np.abs(wav).max() * hparams.rescaling_max).astype(np.float32)
+    else:
+        wav = synthetic_wav(args, hparams)
+
+    start_time = time.time()
+    reference = librosa_melspectrogram(wav, hparams)
+    librosa_duration = time.time() - start_time
+
+    # A crop is computed from its own window of audio, as Dataset does for training
+    max_time_frames = hparams.max_time_steps // hparams.hop_size
+    start = reference.shape[0] // 2
+    window_start = start * hparams.hop_size
+    window_size = (max_time_frames - 1) * hparams.hop_size + hparams.n_fft
+
+    audio = tf.placeholder(tf.float32, shape=[None])
+    mel = tf_melspectrogram(audio, hparams)
+    with tf.Session() as sess:
+        duration, result = time_run(sess, mel, {audio: pad_context(wav, hparams)}, args.runs)
+        crop = sess.run(mel, {audio: pad_context(wav, hparams)[window_start:window_start + window_size]})
+
+    print('librosa: {:.4f} sec, tf: {:.4f} sec for {:.2f} sec of audio'.format(
+        librosa_duration, duration, len(wav) / float(hparams.sample_rate)))
+    print('frames: librosa {}, tf {}'.format(reference.shape[0], result.shape[0]))
+    differences = [('librosa mel', np.max(np.abs(reference - result))),
+                   ('librosa crop mel', np.max(np.abs(reference[start:start + max_time_frames] - crop)))]
+
+    temp_dir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(temp_dir, 'audios'))
+    os.makedirs(os.path.join(temp_dir, 'mels'))
+    wav_path = os.path.join(temp_dir, 'parity.wav')
+    wavfile.write(wav_path, hparams.sample_rate, wav)
+
+    default = hparams.mel_on_the_fly
+    hparams.set_hparam('mel_on_the_fly', False)
+    audio_filename, mel_filename = _process_utterance(temp_dir, 'stored', wav_path, '', 0)[:2]
+    hparams.set_hparam('mel_on_the_fly', True)
+    wav_filename = _process_utterance(temp_dir, 'on_the_fly', wav_path, '', 0)[0]
+    hparams.set_hparam('mel_on_the_fly', default)
+
+    stored_mel = np.load(os.path.join(temp_dir, 'mels', mel_filename))
+    stored_audio = np.load(os.path.join(temp_dir, 'audios', audio_filename))
+    stored_wav = np.load(os.path.join(temp_dir, 'audios', wav_filename))
+    shutil.rmtree(temp_dir)
+
+    # The utterance as the eval set reads it and a crop as NumpyDataset reads it for training
+    utterance = audio_with_context(stored_wav, hparams)[:, np.newaxis]
+    window = context_window(stored_wav, window_start, window_start + window_size, hparams)[:, np.newaxis]
+    wav_start, wav_end, pad_l = wav_bounds(stored_wav.shape[0], hparams)
+    rows = tf.placeholder(tf.float32, shape=[None, 1])
+    frames = tf.placeholder(tf.int32, shape=[])
+    bounds = tf.placeholder(tf.int32, shape=[3])
+    training_mel = tf_melspectrogram(rows[:, 0], hparams)
+    training_audio = tf_training_audio(rows, 0, frames * hparams.hop_size, tf.unstack(bounds), hparams)
+    with tf.Session() as sess:
+        utterance_mel, utterance_audio = sess.run([training_mel, training_audio], {
+            rows: utterance, frames: stored_mel.shape[0], bounds: [wav_start, wav_end, pad_l]})
+        crop, crop_audio = sess.run([training_mel, training_audio], {
+            rows: window, frames: max_time_frames, bounds: [wav_start - window_start, wav_end - window_start, pad_l]})
+
+    crop_start = start * hparams.hop_size
+    differences += [('mel', np.max(np.abs(stored_mel - utterance_mel[:stored_mel.shape[0]]))),
+                    ('crop mel', np.max(np.abs(stored_mel[start:start + max_time_frames] - crop))),
+                    ('training audio', np.max(np.abs(stored_audio - utterance_audio[:, 0]))),
+                    ('crop audio', np.max(np.abs(stored_audio[crop_start:crop_start + hparams.max_time_steps] - crop_audio[:, 0])))]
+
+    print('max abs difference (tolerance {:.1e}):'.format(args.tolerance))
+    for name, difference in differences:
+        print('  {}: {:.3e}{}'.format(name, difference, '' if difference <= args.tolerance else '  FAILED'))
+    failed = [name for name, difference in differences if not difference <= args.tolerance]
+    if failed:
+        sys.exit('mel_parity failed: {}'.format(', '.join(failed)))
+
+
+def mel_frontend(args, hparams):
+    """Files/sec of librosa.load + librosa.feature.melspectrogram against audio.load_wav + audio.melspectrogram."""
+    temp_dir = None
+    if args.wav_dir:
+        paths = [os.path.join(args.wav_dir, f) for f in sorted(os.listdir(args.wav_dir)) if f.endswith('.wav')]
+    else:
+        temp_dir = tempfile.mkdtemp()
+        paths = []
+        for i in range(args.records):
+            paths.append(os.path.join(temp_dir, '%d.wav' % i))
+            wavfile.write(paths[-1], hparams.sample_rate, (synthetic_wav(args, hparams) * 32767).astype(np.int16))
+
+    def librosa_path(path):
+        return librosa_melspectrogram(librosa.load(path, sr=hparams.sample_rate)[0], hparams)
+
+    def frontend_path(path):
+        return melspectrogram(load_wav(path, hparams.sample_rate), hparams)
+
+    results = {}
+    for name, extract in [('librosa', librosa_path), ('audio.py', frontend_path)]:
+        start_time = time.time()
+        results[name] = [extract(path) for path in paths]
+        duration = time.time() - start_time
+        print('{}: {} files in {:.2f} sec, {:.1f} files/sec'.format(name, len(paths), duration, len(paths) / duration))
+
+    print('max abs difference: {:.3e}'.format(max(np.max(np.abs(a - b)) for a, b in zip(results['librosa'], results['audio.py']))))
+
+    if temp_dir is not None:
+        for path in paths:
+            os.remove(path)
+        os.rmdir(temp_dir)
+
+
+def gradient_all_reduce(args, hparams):
+    """Per-variable gradient averaging against fused all-reduces, across --towers virtual CPU devices
+    with random gradients shaped like the variables of the model."""
+    with tf.Graph().as_default():
+        with tf.variable_scope('vocoder', custom_getter=fp16_dtype_getter):
+            x = tf.placeholder(tf.float32, shape=[None, None, 1])
+            c = tf.placeholder(tf.float32, shape=[None, None, hparams.num_mels])
+            FloWaveNet(hparams).forward(x, c)
+        shapes = [v.shape.as_list() for v in tf.trainable_variables()]
+
+    devices = ['/cpu:%d' % i for i in range(args.towers)]
+    with tf.Graph().as_default():
+        with tf.device(devices[0]):
+            variables = [tf.Variable(tf.zeros(shape), name='variable_%d' % i) for i, shape in enumerate(shapes)]
+
+        tower_grads = []
+        for device in devices:
+            with tf.device(device):
+                tower_grads.append([(tf.Variable(tf.random_normal(v.shape)), v) for v in variables])
+
+        results = []
+        with tf.device(devices[0]):
+            results.append(('per variable', average_gradients(tower_grads)))
+        for algorithm in ['ring', 'hd']:
+            if algorithm == 'hd' and args.towers & (args.towers - 1) != 0:
+                continue
+            results.append((algorithm, all_reduce_gradients(tower_grads, devices, algorithm, hparams.all_reduce_bucket_mb)))
+
+        config = tf.ConfigProto(device_count={'CPU': args.towers})
+        with tf.Session(config=config) as sess:
+            sess.run(tf.global_variables_initializer())
+            reference = None
+            for name, grad_vars in results:
+                duration, values = time_run(sess, [g for g, _ in grad_vars], None, args.runs)
+                reference = values if reference is None else reference
+                difference = max(np.max(np.abs(a - b)) for a, b in zip(reference, values))
+                print('{}: {} gradients ({:.1f} MB) over {} towers, {:.4f} sec, max abs difference {:.3e}'.format(
+                    name, len(variables), sum(np.prod(shape) for shape in shapes) * 4 / 2 ** 20, args.towers,
+                    duration, difference))
+
+
+def pipeline(args, hparams):
+    """Training steps with the Blocks split over --towers virtual CPU devices and --micro_batches
+    micro-batches, against all Blocks on one device.
+
+    The bubble overhead is the share of the step the stage devices are idle, measured from the
+    op timings of a traced run, next to the (S - 1) / (M + S - 1) of an ideal GPipe schedule.
+    """
+    if args.batch_size % args.micro_batches != 0:
+        raise ValueError('--batch_size has to be a multiple of --micro_batches')
+
+    devices = ['/cpu:%d' % i for i in range(args.towers)]
+    costs = block_costs(hparams)
+    stages = partition_blocks(costs, args.towers)
+    stage_costs = [sum(cost for cost, stage in zip(costs, stages) if stage == i) for i in range(args.towers)]
+    print('Stage of every Block: {}, share of the cost per stage: {}'.format(
+        stages, ', '.join('{:.2f}'.format(cost / sum(costs)) for cost in stage_costs)))
+
+    audio, mel = random_batch(args, hparams)
+    config = tf.ConfigProto(device_count={'CPU': args.towers}, allow_soft_placement=True)
+    baseline = None
+    for name, num_stages, micro_batches in [('single device', 1, 1), ('pipeline', args.towers, args.micro_batches)]:
+        with tf.Graph().as_default():
+            x = tf.placeholder(tf.float32, shape=[args.batch_size, None, 1])
+            c = tf.placeholder(tf.float32, shape=[args.batch_size, None, hparams.num_mels])
+            with tf.variable_scope('vocoder', custom_getter=fp16_dtype_getter):
+                log_p, logdet = FloWaveNet(hparams).forward_pipelined(x, c, None, devices[:num_stages], micro_batches)
+                loss = -(log_p + logdet)
+
+            variables = tf.trainable_variables()
+            grads = tf.gradients(tf.scalar_mul(hparams.scale, loss), variables, colocate_gradients_with_ops=True)
+            grad_vars = [(tf.scalar_mul(1. / hparams.scale, g), v) for g, v in zip(grads, variables) if g is not None]
+            train_op = tf.train.AdamOptimizer(0.001).apply_gradients(grad_vars)
+
+            with tf.Session(config=config) as sess:
+                sess.run(tf.global_variables_initializer())
+                feed_dict = {x: audio, c: mel}
+                duration, _ = time_run(sess, train_op, feed_dict, args.runs)
+                wall, busy = device_busy_times(sess, train_op, feed_dict)
+
+        stage_busy = [time for device, time in busy.items() if any(device.endswith('CPU:%d' % i) for i in range(num_stages))]
+        bubble = 1 - np.mean(stage_busy) / wall
+        ideal = (num_stages - 1) / (micro_batches + num_stages - 1)
+        baseline = duration if baseline is None else baseline
+        print('{}: {} stages, {} micro-batches, {:.3f} sec/step, {:.1f} samples/sec, speedup {:.2f}x, '
+              'bubble overhead {:.1%} (ideal {:.1%})'.format(
+                  name, num_stages, micro_batches, duration, args.batch_size / duration, baseline / duration, bubble, ideal))
+
+
+def xla(args, hparams):
+    """Training step time and synthesis RTF without XLA, with every Flow compiled separately and
+    with the whole graph compiled. The first run of every graph includes the compilation."""
+    audio, mel = random_batch(args, hparams)
+    z = np.random.normal(size=audio.shape).astype(np.float32) * hparams.temp
+    audio_duration = args.batch_size * args.frames * hparams.hop_size / hparams.sample_rate
+    default = hparams.xla
+    # XLA reads its flags once with the first session, before the mode with a global jit level runs (see utils.jit_config)
+    os.environ['TF_XLA_FLAGS'] = (os.environ.get('TF_XLA_FLAGS', '') + ' --tf_xla_cpu_global_jit').strip()
+
+    reference = None
+    for mode in ['', 'flow', 'global']:
+        hparams.set_hparam('xla', mode)
+        with tf.Graph().as_default():
+            x = tf.placeholder(tf.float32, shape=[None, None, 1])
+            c = tf.placeholder(tf.float32, shape=[None, None, hparams.num_mels])
+            with tf.variable_scope('vocoder', custom_getter=fp16_dtype_getter):
+                model = FloWaveNet(hparams)
+                log_p, logdet = model.forward(x, c)
+                loss = -(log_p + logdet)
+                predictions = model.reverse(x, c)
+
+            variables = tf.trainable_variables()
+            grads = tf.gradients(tf.scalar_mul(hparams.scale, loss), variables)
+            grad_vars = [(tf.scalar_mul(1. / hparams.scale, g), v) for g, v in zip(grads, variables) if g is not None]
+            train_op = tf.train.AdamOptimizer(0.001).apply_gradients(grad_vars)
+
+            with tf.Session(config=jit_config(hparams)) as sess:
+                # Same weights for every mode
+                np.random.seed(0)
+                randomize_variables(sess)
+
+                start_time = time.time()
+                sess.run(predictions, feed_dict={x: z, c: mel})
+                compile_duration = time.time() - start_time
+                synthesis_duration, result = time_run(sess, predictions, {x: z, c: mel}, args.runs)
+                step_duration, _ = time_run(sess, [loss, train_op], {x: audio, c: mel}, args.runs)
+
+        reference = result if reference is None else reference
+        print('xla={!r}: {:.3f} sec/step, synthesis {:.3f} sec (RTF={:.3f}, first run {:.3f} sec), max abs difference {:.3e}'.format(
+            mode, step_duration, synthesis_duration, synthesis_duration / audio_duration, compile_duration,
+            np.max(np.abs(result.astype(np.float32) - reference.astype(np.float32)))))
+
+    hparams.set_hparam('xla', default)
+
+
+BENCHMARKS = {
+    'fused_reverse': fused_reverse,
+    'gradient_all_reduce': gradient_all_reduce,
+    'pipeline': pipeline,
+    'input_pipeline': input_pipeline,
+    'mel_frontend': mel_frontend,
+    'mel_parity': mel_parity,
+    'shared_conditioning': shared_conditioning,
+    'cin_bottleneck': cin_bottleneck,
+    'reversible': reversible,
+    'checkpointing': checkpointing,
+    'tfrecord_parse': tfrecord_parse,
+    'xla': xla,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--frames', type=int, default=64, help='Number of mel frames per item')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--steps', type=int, default=50, help='Training steps for the loss comparisons')
+    parser.add_argument('--sizes', type=int, default=3, help='Number of crop lengths (doubling from --frames) for memory scaling')
+    parser.add_argument('--memory_budget', type=int, default=8192, help='Memory in MB the longest crop is extrapolated for')
+    parser.add_argument('--records', type=int, default=64, help='Number of synthetic utterances written for tfrecord_parse')
+    parser.add_argument('--data_dir', default='training_data', help='Folder with the tfrecords or train.txt for input_pipeline')
+    parser.add_argument('--batches', type=int, default=200, help='Number of batches timed by input_pipeline')
+    parser.add_argument('--wav', default='', help='Audio file for mel_parity, a synthetic signal is used otherwise')
+    parser.add_argument('--tolerance', type=float, default=1e-3, help='Largest max abs difference mel_parity accepts')
+    parser.add_argument('--wav_dir', default='', help='Folder with wavs for mel_frontend, synthetic wavs are used otherwise')
+    parser.add_argument('--towers', type=int, default=4, help='Number of virtual CPU devices for gradient_all_reduce and pipeline')
+    parser.add_argument('--micro_batches', type=int, default=4, help='Micro-batches per batch for pipeline')
+    parser.add_argument('--float32', action='store_true', help='Run the model in float32 instead of hparams.dtype')
+    args = parser.parse_args()
+
+    if args.float32:
+        hparams.set_hparam('dtype', tf.float32)
+
+    BENCHMARKS[args.benchmark](args, hparams)
+
+if __name__ == '__main__':
+    main()
@@ -3,29 +3,38 @@ import numpy as np
 import os
 from sklearn.model_selection import train_test_split
 import multiprocessing
+from audio import tf_melspectrogram, tf_training_audio, stft_context, audio_with_context, context_window, wav_bounds
 
 
 class Dataset:
-    def __init__(self,  train_tfrecord, test_tfrecord, hparams):
-        self._hparams = hparams
+    def __init__(self,  train_tfrecord, test_tfrecord, hparams, num_shards=1, shard_index=0):
         self._train_tfrecord = train_tfrecord
         self._test_tfrecord = test_tfrecord      
-        
+
+        # Each of `num_shards` training processes reads its own part of the training set: whole
+        # files when there are enough of them, every num_shards-th record otherwise
+        self._num_shards = num_shards
+        self._shard_index = shard_index
+        self._shard_records = num_shards > 1 and len(self._get_filenames(train_tfrecord)) < num_shards
+        self._build(hparams)
+
+    def _build(self, hparams):
+        self._hparams = hparams
         self._max_time_frames = self._hparams.max_time_steps // self._hparams.hop_size
         self._max_time_steps = self._max_time_frames * self._hparams.hop_size
         
         self._pad = 0.    
-        n_cpu = multiprocessing.cpu_count()
-        buffer_size = 64
 
+        n_cpu = multiprocessing.cpu_count()
         with tf.device('/cpu:0'):
-            self._filenames = tf.placeholder(tf.string, shape=[None])
-            dataset = tf.data.TFRecordDataset(self._filenames)
-            dataset = dataset.apply(tf.data.experimental.shuffle_and_repeat(buffer_size))
-            dataset = dataset.map(self._load_sample, n_cpu)
-            # dataset = dataset.apply(tf.data.experimental.ignore_errors())
-            dataset = dataset.batch(self._hparams.batch_size)
-            dataset = dataset.prefetch(self._hparams.num_gpus)
+            dataset = self._make_dataset(n_cpu, buffer_size=64)
+
+            # One pass over the test set in a fixed order, every utterance cut into consecutive crops
+            eval_dataset = self._make_eval_dataset(n_cpu)
+            eval_dataset = eval_dataset.map(self._split_crops, n_cpu)
+            eval_dataset = eval_dataset.apply(tf.data.experimental.unbatch())
+            eval_dataset = eval_dataset.batch(self._hparams.batch_size)
+            eval_dataset = eval_dataset.prefetch(1)
 
         self._train_iterator = dataset.make_initializable_iterator()
         self.inputs = []
@@ -37,7 +46,7 @@ class Dataset:
             self.inputs.append(train_batch[1])
             self.speaker_ids.append(train_batch[2])
                 
-        self._test_iterator = dataset.make_initializable_iterator()
+        self._test_iterator = eval_dataset.make_initializable_iterator()
         test_batch = self._test_iterator.get_next()
         self.eval_local_conditions = test_batch[0]
         self.eval_inputs = test_batch[1]
@@ -47,34 +56,115 @@ class Dataset:
             self.speaker_ids = [None] * hparams.num_gpus
             self.eval_speaker_ids = None
 
+    def _make_dataset(self, n_cpu, buffer_size):
+        self._filenames = tf.placeholder(tf.string, shape=[None])
+        num_files = tf.cast(tf.size(self._filenames), tf.int64)
+
+        # Shards are shuffled and read in parallel, never more at once than there are files
+        # so that a single tfrecord is not interleaved with copies of itself
+        files = tf.data.Dataset.from_tensor_slices(self._filenames)
+        files = files.apply(tf.data.experimental.shuffle_and_repeat(num_files, seed=self._hparams.shuffle_random_seed))
+        dataset = files.apply(tf.data.experimental.parallel_interleave(
+            self._read_tfrecord, cycle_length=tf.minimum(num_files, n_cpu), sloppy=False))
+        if self._shard_records:
+            dataset = dataset.shard(self._num_shards, self._shard_index)
+
+        dataset = dataset.shuffle(buffer_size, seed=self._hparams.shuffle_random_seed)
+        dataset = dataset.apply(tf.data.experimental.map_and_batch(self._load_sample, self._hparams.batch_size,
+            num_parallel_calls=tf.data.experimental.AUTOTUNE))
+        # dataset = dataset.apply(tf.data.experimental.ignore_errors())
+        return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+    def _make_eval_dataset(self, n_cpu):
+        self._eval_filenames = tf.placeholder(tf.string, shape=[None])
+        dataset = tf.data.TFRecordDataset(self._eval_filenames, compression_type=self._hparams.tfrecord_compression)
+        return dataset.map(self._parse_eval_sample, n_cpu)
+
+    def _read_tfrecord(self, filename):
+        return tf.data.TFRecordDataset(filename, compression_type=self._hparams.tfrecord_compression)
+
+
     def _load_sample(self, data_record):
+        mel, audio, speaker_id = self._parse_sample(data_record)
+
+        if self._hparams.mel_on_the_fly:
+            n_frames = (tf.shape(audio)[0] - 2 * stft_context(self._hparams)) // self._hparams.hop_size
+            start = tf.random.uniform([], 0, n_frames - self._max_time_frames + 1, dtype=tf.int32)
+            mel, audio = self._crop_with_mel(audio, start, bounds=mel)
+            return self._finish_sample(mel, audio, speaker_id)
+
+        start = tf.random.uniform([1], 0, tf.shape(mel)[0] - self._max_time_frames + 1, dtype=tf.int32)
+        time_start = start[0] * self._hparams.hop_size
+        audio = audio[time_start:time_start + self._max_time_steps]
+        mel = mel[start[0]:start[0] + self._max_time_frames]
+        return self._finish_sample(mel, audio, speaker_id)
+
+
+    def _parse_sample(self, data_record):
+        # Records written before tfrecord_version=2 store FloatLists, newer ones raw bytes
         features = {
             'audio': tf.VarLenFeature(tf.float32),
+            'audio_raw': tf.FixedLenFeature([], tf.string, default_value=''),
+            'audio_pcm16': tf.FixedLenFeature([], tf.int64, default_value=0),
             'audio_len': tf.FixedLenFeature([], tf.int64),
-            'mel_shape': tf.FixedLenFeature([2], tf.int64),
-            'mel': tf.VarLenFeature(tf.float32)
         }
 
+        if not self._hparams.mel_on_the_fly:
+            features['mel_shape'] = tf.FixedLenFeature([2], tf.int64)
+            features['mel'] = tf.VarLenFeature(tf.float32)
+            features['mel_raw'] = tf.FixedLenFeature([], tf.string, default_value='')
+
+        else:
+            features['wav_bounds'] = tf.FixedLenFeature([3], tf.int64)
+
         if self._hparams.gin_channels > 0:
             features['speaker_id'] = tf.FixedLenFeature([], tf.int64)
 
         sample = tf.parse_single_example(data_record, features)
-        audio = tf.sparse.to_dense(sample['audio'])
+        audio = self._decode_audio(sample)
         # audio = tf.cast(audio, tf.float32)
         audio_len =  tf.cast(sample['audio_len'], tf.int32)
+        speaker_id = tf.cast(sample['speaker_id'], tf.int32) if self._hparams.gin_channels > 0 else 0
+
         audio = tf.reshape(audio, [audio_len, 1])
 
+        # With mel_on_the_fly the audio holds rows of audio.audio_with_context, the mel is left to the
+        # caller and the wav bounds of the record are returned in its place
+        if self._hparams.mel_on_the_fly:
+            return tf.cast(sample['wav_bounds'], tf.int32), audio, speaker_id
+
         mel_shape = tf.cast(sample['mel_shape'], tf.int32)
-        mel = tf.sparse.to_dense(sample['mel'])
+        mel = tf.cond(tf.not_equal(sample['mel_raw'], ''),
+                      true_fn=lambda: tf.decode_raw(sample['mel_raw'], tf.float32),
+                      false_fn=lambda: tf.sparse.to_dense(sample['mel']))
         mel = tf.reshape(mel, [mel_shape[0], mel_shape[1]])
-        speaker_id = tf.cast(sample['speaker_id'], tf.int32) if self._hparams.gin_channels > 0 else 0
+        return mel, audio, speaker_id
 
-        
-        start = tf.random.uniform([1], 0, tf.shape(mel)[0] - self._max_time_frames, dtype=tf.int32)
-        time_start = start[0] * self._hparams.hop_size
-        audio = audio[time_start:time_start + self._max_time_steps]
-        mel = mel[start[0]:start[0] + self._max_time_frames]
-        
+
+    def _parse_eval_sample(self, data_record):
+        mel, audio, speaker_id = self._parse_sample(data_record)
+        if self._hparams.mel_on_the_fly:
+            mel, audio = self._mel_from_audio(audio, bounds=mel)
+        return mel, audio, speaker_id
+
+
+    def _crop_with_mel(self, audio, start, bounds):
+        """Crops max_time_frames frames from `start` out of rows of audio_with_context with the
+        given wav bounds and computes the mel of the crop only."""
+        time_start = start * self._hparams.hop_size
+        window_size = (self._max_time_frames - 1) * self._hparams.hop_size + self._hparams.n_fft
+        mel = tf_melspectrogram(audio[time_start:time_start + window_size, 0], self._hparams)
+        return mel, tf_training_audio(audio, start, self._max_time_steps, tf.unstack(bounds), self._hparams)
+
+
+    def _mel_from_audio(self, audio, bounds):
+        """Mel and training audio of a whole utterance stored as audio_with_context with the given wav bounds."""
+        n_frames = (tf.shape(audio)[0] - 2 * stft_context(self._hparams)) // self._hparams.hop_size
+        mel = tf_melspectrogram(audio[:, 0], self._hparams)[:n_frames]
+        return mel, tf_training_audio(audio, 0, n_frames * self._hparams.hop_size, tf.unstack(bounds), self._hparams)
+
+
+    def _finish_sample(self, mel, audio, speaker_id):
         audio.set_shape([None, 1])
         mel.set_shape([None, self._hparams.num_mels])
         
@@ -85,16 +175,173 @@ class Dataset:
         return mel, audio, speaker_id
 
 
+    def _split_crops(self, mel, audio, speaker_id):
+        """Cuts an utterance into consecutive training crops, a clip shorter than one crop is zero padded."""
+        mel_pad = tf.maximum(self._max_time_frames - tf.shape(mel)[0], 0)
+        mel = tf.pad(mel, [[0, mel_pad], [0, 0]], constant_values=self._pad)
+        audio = tf.pad(audio, [[0, mel_pad * self._hparams.hop_size], [0, 0]], constant_values=self._pad)
+
+        n_crops = tf.shape(mel)[0] // self._max_time_frames
+        mels = tf.reshape(mel[:n_crops * self._max_time_frames], [n_crops, self._max_time_frames, self._hparams.num_mels])
+        audios = tf.reshape(audio[:n_crops * self._max_time_steps], [n_crops, self._max_time_steps, 1])
+        speaker_ids = tf.fill([n_crops], speaker_id)
+
+        if self._hparams.dtype == tf.float16:
+            audios = tf.cast(audios, tf.float16)
+            mels = tf.cast(mels, tf.float16)
+
+        return mels, audios, speaker_ids
+
+
+    def _decode_audio(self, sample):
+        def decode_raw():
+            return tf.cond(tf.equal(sample['audio_pcm16'], 1),
+                           true_fn=lambda: tf.cast(tf.decode_raw(sample['audio_raw'], tf.int16), tf.float32) / 32767.,
+                           false_fn=lambda: tf.decode_raw(sample['audio_raw'], tf.float32))
+
+        return tf.cond(tf.not_equal(sample['audio_raw'], ''),
+                       true_fn=decode_raw,
+                       false_fn=lambda: tf.sparse.to_dense(sample['audio']))
+
+
     def _postprocess_batch(self, mels, audios, speaker_ids):
         return mels, audios, tf.squeeze(speaker_ids)
 
         
+    def _get_filenames(self, pattern):
+        filenames = sorted(tf.gfile.Glob(pattern))
+        if not filenames:
+            raise ValueError('No tfrecords match {}'.format(pattern))
+        return filenames
+
+
     def initialize(self, sess):
         # audio_filename, mel_filename, time_steps, N, speaker_id, text
+        filenames = self._get_filenames(self._train_tfrecord)
+        if not self._shard_records:
+            filenames = filenames[self._shard_index::self._num_shards]
+
         sess.run(self._train_iterator.initializer, feed_dict={
-            self._filenames: [self._train_tfrecord]
+            self._filenames: filenames
         })
 
+
+    def initialize_eval(self, sess):
+        """Starts a new pass over the test set, eval_* tensors raise OutOfRangeError at its end."""
         sess.run(self._test_iterator.initializer, feed_dict={
-            self._filenames: [self._test_tfrecord]
+            self._eval_filenames: self._get_filenames(self._test_tfrecord)
         })
+
+
+class NumpyDataset(Dataset):
+    """Serves training crops straight from the .npy files written by preprocessing.py.
+
+    The files are opened with mmap_mode, so only the pages of a crop are read and
+    repeated epochs are served from the page cache. Lengths and speaker ids from
+    train.txt are kept in arrays, crop offsets are drawn in the graph and a pool of
+    tf.data workers slices the crops.
+    """
+    def __init__(self, metadata_filename, hparams, num_shards=1, shard_index=0):
+        self._basedir = os.path.dirname(metadata_filename)
+        with open(metadata_filename, encoding='utf-8') as f:
+            metadata = [line.strip().split('|') for line in f]
+
+        self._audio_filenames = [m[0] for m in metadata]
+        self._mel_filenames = [m[1] for m in metadata]
+        self._frames = np.array([int(m[2]) // hparams.hop_size for m in metadata], dtype=np.int32)
+        self._speaker_ids = np.array([int(m[3]) for m in metadata], dtype=np.int32)
+
+        # Same split as TFRecordCreator.create_tfrecords
+        indices = np.arange(len(metadata))
+        self._train_indices, self._test_indices = train_test_split(indices,
+            test_size=hparams.test_size, random_state=hparams.split_random_state)
+        self._train_indices = self._train_indices[shard_index::num_shards]
+
+        self._build(hparams)
+
+    def _make_dataset(self, n_cpu, buffer_size):
+        self._indices = tf.placeholder(tf.int64, shape=[None])
+
+        dataset = tf.data.Dataset.from_tensor_slices(self._indices)
+        dataset = dataset.apply(tf.data.experimental.shuffle_and_repeat(tf.cast(tf.size(self._indices), tf.int64),
+                                                                        seed=self._hparams.shuffle_random_seed))
+        dataset = dataset.apply(tf.data.experimental.map_and_batch(self._load_crop, self._hparams.batch_size,
+            num_parallel_calls=tf.data.experimental.AUTOTUNE))
+        return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+    def _make_eval_dataset(self, n_cpu):
+        dataset = tf.data.Dataset.from_tensor_slices(self._test_indices)
+        return dataset.map(self._load_utterance, n_cpu)
+
+    def _load_utterance(self, index):
+        speaker_id = tf.gather(self._speaker_ids, index) if self._hparams.gin_channels > 0 else 0
+        if self._hparams.mel_on_the_fly:
+            audio, bounds = tf.py_func(self._py_load_audio, [index], [tf.float32, tf.int32], stateful=False)
+            audio.set_shape([None, 1])
+            bounds.set_shape([3])
+            mel, audio = self._mel_from_audio(audio, bounds)
+            return mel, audio, speaker_id
+
+        mel, audio = tf.py_func(self._py_load_utterance, [index], [tf.float32, tf.float32], stateful=False)
+        mel.set_shape([None, self._hparams.num_mels])
+        audio.set_shape([None, 1])
+        return mel, audio, speaker_id
+
+    def _py_load_utterance(self, index):
+        mel = np.load(os.path.join(self._basedir, 'mels', self._mel_filenames[index]))
+        audio = np.load(os.path.join(self._basedir, 'audios', self._audio_filenames[index]))
+        return mel.astype(np.float32), audio.astype(np.float32)[:, np.newaxis]
+
+    def _py_load_audio(self, index):
+        wav = np.load(os.path.join(self._basedir, 'audios', self._audio_filenames[index]))
+        bounds = np.array(wav_bounds(wav.shape[0], self._hparams), dtype=np.int32)
+        return audio_with_context(wav, self._hparams)[:, np.newaxis], bounds
+
+    def _load_crop(self, index):
+        frames = tf.gather(self._frames, index)
+        start = tf.random.uniform([], 0, tf.maximum(frames - self._max_time_frames, 0) + 1, dtype=tf.int32)
+        speaker_id = tf.gather(self._speaker_ids, index) if self._hparams.gin_channels > 0 else 0
+
+        if self._hparams.mel_on_the_fly:
+            audio, bounds = tf.py_func(self._py_load_window, [index, start], [tf.float32, tf.int32], stateful=False)
+            audio.set_shape([None, 1])
+            bounds.set_shape([3])
+            mel, audio = self._crop_with_mel(audio, 0, bounds)
+            return self._finish_sample(mel, audio, speaker_id)
+
+        mel, audio = tf.py_func(self._py_load_crop, [index, start], [tf.float32, tf.float32], stateful=False)
+        return self._finish_sample(mel, audio, speaker_id)
+
+    def _py_load_window(self, index, start):
+        """Rows of audio_with_context covering a crop and the STFT windows of its frames, and the wav
+        bounds relative to them."""
+        wav = np.load(os.path.join(self._basedir, 'audios', self._audio_filenames[index]), mmap_mode='r')
+        begin = start * self._hparams.hop_size
+        end = begin + (self._max_time_frames - 1) * self._hparams.hop_size + self._hparams.n_fft
+        wav_start, wav_end, pad_l = wav_bounds(wav.shape[0], self._hparams)
+        bounds = np.array([wav_start - begin, wav_end - begin, pad_l], dtype=np.int32)
+        return context_window(wav, begin, end, self._hparams)[:, np.newaxis], bounds
+
+    def _py_load_crop(self, index, start):
+        hop_size = self._hparams.hop_size
+        mel = np.load(os.path.join(self._basedir, 'mels', self._mel_filenames[index]), mmap_mode='r')
+        audio = np.load(os.path.join(self._basedir, 'audios', self._audio_filenames[index]), mmap_mode='r')
+
+        mel = np.array(mel[start:start + self._max_time_frames], dtype=np.float32)
+        audio = np.array(audio[start * hop_size:start * hop_size + self._max_time_steps], dtype=np.float32)
+
+        # Clips shorter than a crop are zero padded
+        if mel.shape[0] < self._max_time_frames:
+            mel_pad = self._max_time_frames - mel.shape[0]
+            mel = np.pad(mel, ((0, mel_pad), (0, 0)), mode='constant', constant_values=self._pad)
+            audio = np.pad(audio, (0, self._max_time_steps - audio.shape[0]), mode='constant', constant_values=self._pad)
+
+        return mel, audio[:, np.newaxis]
+
+    def initialize(self, sess):
+        sess.run(self._train_iterator.initializer, feed_dict={
+            self._indices: self._train_indices
+        })
+
+    def initialize_eval(self, sess):
+        sess.run(self._test_iterator.initializer)
@@ -0,0 +1,68 @@
+import os
+import socket
+import subprocess
+import sys
+import tensorflow as tf
+
+
+def get_cluster(ps_hosts, worker_hosts):
+    """ClusterSpec of comma separated host:port lists."""
+    return tf.train.ClusterSpec({'ps': ps_hosts.split(','), 'worker': worker_hosts.split(',')})
+
+
+def _free_ports(n):
+    sockets = [socket.socket() for _ in range(n)]
+    for s in sockets:
+        s.bind(('localhost', 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def _strip_arg(argv, name):
+    """Removes `--name value` and `--name=value` from a list of command line arguments."""
+    result = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == name:
+            skip = True
+        elif not arg.startswith(name + '='):
+            result.append(arg)
+    return result
+
+
+def launch_local_cluster(script, argv, num_workers, num_ps=1, timeout=60):
+    """Runs `script` as `num_ps` parameter servers and `num_workers` workers on localhost.
+
+    Every process gets its own port and no GPU, so a cluster can be tested on one CPU-only
+    host. Returns the exit code of the chief once it finished, the other workers get
+    `timeout` seconds to follow and the parameter servers are stopped afterwards.
+    """
+    argv = _strip_arg(argv, '--local_workers')
+    ports = _free_ports(num_ps + num_workers)
+    hosts = ['localhost:%d' % port for port in ports]
+    command = [sys.executable, script] + argv + ['--ps_hosts', ','.join(hosts[:num_ps]),
+                                                 '--worker_hosts', ','.join(hosts[num_ps:])]
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='')
+
+    ps = [subprocess.Popen(command + ['--job_name', 'ps', '--task_index', str(i)], env=env) for i in range(num_ps)]
+    workers = [subprocess.Popen(command + ['--job_name', 'worker', '--task_index', str(i)], env=env)
+               for i in range(num_workers)]
+    try:
+        returncode = workers[0].wait()
+        for worker in workers[1:]:
+            try:
+                worker.wait(timeout)
+            except subprocess.TimeoutExpired:
+                # Workers can stay blocked on the sync queues once the chief stopped
+                worker.terminate()
+                worker.wait()
+    finally:
+        for process in ps + workers:
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+    return returncode
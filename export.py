@@ -0,0 +1,69 @@
+import tensorflow as tf
+import os
+import time
+import argparse
+from tensorflow.tools.graph_transforms import TransformGraph
+from hparams import hparams
+from synthesize import get_model, load_frozen_graph
+
+
+# Variables are turned into constants first, so folding evaluates the weight-normed
+# kernels, the ActNorm parameters and the fp16 casts of the variables once.
+TRANSFORMS = [
+    'strip_unused_nodes',
+    'remove_nodes(op=Identity, op=CheckNumerics)',
+    'fold_constants(ignore_errors=true)',
+    'sort_by_execution_order',
+]
+
+
+def export(args, hparams):
+    graph = tf.Graph()
+    with graph.as_default():
+        start_time = time.time()
+        predictions, lc, _ = get_model(hparams, fused=args.fused)
+        saver = tf.train.Saver()
+
+        checkpoint_state = tf.train.get_checkpoint_state(args.saved_dir)
+        if not (checkpoint_state and checkpoint_state.model_checkpoint_path):
+            print('No checkpoint found in {}'.format(args.saved_dir))
+            return
+
+        with tf.Session() as sess:
+            print('Loading checkpoint {}'.format(checkpoint_state.model_checkpoint_path))
+            saver.restore(sess, checkpoint_state.model_checkpoint_path)
+            restore_duration = time.time() - start_time
+
+            graph_def = tf.graph_util.convert_variables_to_constants(
+                sess, graph.as_graph_def(), [predictions.op.name])
+
+    # The noise placeholder is left out of the inputs: strip_unused_nodes would turn it
+    # into a plain placeholder and drop its random default.
+    graph_def = TransformGraph(graph_def, [lc.op.name], [predictions.op.name], TRANSFORMS)
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    with tf.gfile.GFile(args.output, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    print('Wrote {} ({} nodes)'.format(args.output, len(graph_def.node)))
+
+    with tf.Graph().as_default():
+        start_time = time.time()
+        load_frozen_graph(args.output)
+        with tf.Session():
+            load_duration = time.time() - start_time
+    print('Graph building and checkpoint restore: {:.3f} sec, frozen graph load: {:.3f} sec'.format(restore_duration, load_duration))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--saved_dir', default='logs/pretrained/', help='Folder with model checkpoint')
+    parser.add_argument('--output', default='logs/frozen/flowavenet.pb', help='Path of the exported inference graph')
+    parser.add_argument('--fused', action='store_true', help='Merge ActNorm layers into the coupling networks')
+
+    args = parser.parse_args()
+    export(args, hparams)
+
+if __name__ == '__main__':
+    main()
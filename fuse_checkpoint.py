@@ -0,0 +1,125 @@
+import tensorflow as tf
+import numpy as np
+import os
+import argparse
+from hparams import hparams
+from model import FloWaveNet
+from utils import fp16_dtype_getter
+
+
+def build_model(hparams, **overrides):
+    """Builds the variables of a FloWaveNet with some of the hparams overridden."""
+    hparams = tf.contrib.training.HParams(**hparams.values())
+    for name, value in overrides.items():
+        hparams.set_hparam(name, value)
+
+    with tf.Graph().as_default():
+        with tf.variable_scope('vocoder', custom_getter=fp16_dtype_getter):
+            lc = tf.placeholder(tf.float32, shape=[None, None, hparams.num_mels])
+            z = tf.placeholder(tf.float32, shape=[None, None, 1])
+            g = tf.placeholder(tf.int32, shape=[None]) if hparams.gin_channels > 0 else None
+
+            model = FloWaveNet(hparams)
+            model.reverse(z, lc, g)
+    return model
+
+
+def wavenets(model):
+    for block in model._blocks:
+        for flow in block._flows:
+            yield flow._coupling._net
+
+
+def get_fused_mapping(hparams):
+    """Maps names of variables of the model described by `hparams` to the list of
+    variables of the unfused model concatenated into them."""
+    mapping = {}
+
+    def add_layer(new_layer, layers):
+        if not new_layer.built:
+            return
+        for suffix in ['kernel', 'wn/g', 'bias']:
+            mapping['%s/%s' % (new_layer.scope_name, suffix)] = ['%s/%s' % (layer.scope_name, suffix) for layer in layers]
+
+    old_model = build_model(hparams, fused_gate=False, shared_conditioning=False)
+    new_model = build_model(hparams)
+
+    for old_net, new_net in zip(wavenets(old_model), wavenets(new_model)):
+        if new_net._shared_conditioning:
+            add_layer(new_net._conv_c, [layer for old in old_net._res_blocks for layer in [old._filter_conv_c, old._gate_conv_c]])
+
+        for old, new in zip(old_net._res_blocks, new_net._res_blocks):
+            add_layer(new._res_conv, [old._res_conv])
+            if new._skip:
+                add_layer(new._skip_conv, [old._skip_conv])
+
+            if new._fused_gate:
+                add_layer(new._conv._conv, [old._filter_conv._conv, old._gate_conv._conv])
+                if new._local_conditioning:
+                    add_layer(new._conv_c, [old._filter_conv_c, old._gate_conv_c])
+                if new._global_conditioning:
+                    add_layer(new._conv_g, [old._filter_conv_g, old._gate_conv_g])
+            else:
+                add_layer(new._filter_conv._conv, [old._filter_conv._conv])
+                add_layer(new._gate_conv._conv, [old._gate_conv._conv])
+                if new._local_conditioning:
+                    add_layer(new._filter_conv_c, [old._filter_conv_c])
+                    add_layer(new._gate_conv_c, [old._gate_conv_c])
+                if new._global_conditioning:
+                    add_layer(new._filter_conv_g, [old._filter_conv_g])
+                    add_layer(new._gate_conv_g, [old._gate_conv_g])
+
+    return mapping
+
+
+def convert(args, hparams):
+    checkpoint_state = tf.train.get_checkpoint_state(args.saved_dir)
+    if not (checkpoint_state and checkpoint_state.model_checkpoint_path):
+        print('No checkpoint found in {}'.format(args.saved_dir))
+        return
+
+    print('Loading checkpoint {}'.format(checkpoint_state.model_checkpoint_path))
+    reader = tf.train.load_checkpoint(checkpoint_state.model_checkpoint_path)
+    names = set(reader.get_variable_to_shape_map())
+
+    mapping = get_fused_mapping(hparams)
+    fused_names = set(name for sources in mapping.values() for name in sources)
+
+    # Optimizer slots (e.g. kernel/Adam) follow the variables they belong to.
+    slots = set(name[len(source):] for name in names for source in [name.rsplit('/', 1)[0]] if source in fused_names)
+
+    values = {}
+    for name in names:
+        if name in fused_names or name.rsplit('/', 1)[0] in fused_names:
+            continue
+        values[name] = reader.get_tensor(name)
+
+    for name, sources in mapping.items():
+        for slot in [''] + sorted(slots):
+            if sources[0] + slot in names:
+                values[name + slot] = np.concatenate([reader.get_tensor(source + slot) for source in sources], axis=-1)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    checkpoint_path = os.path.join(args.output_dir, os.path.basename(checkpoint_state.model_checkpoint_path))
+    with tf.Graph().as_default():
+        variables = [tf.Variable(value, name=name) for name, value in sorted(values.items())]
+        saver = tf.train.Saver(var_list=variables)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            saver.save(sess, checkpoint_path)
+
+    print('Wrote {} ({} variables, {} converted)'.format(checkpoint_path, len(values), len(mapping)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--saved_dir', default='logs/pretrained/',
+        help='Folder with a checkpoint trained with fused_gate=False and shared_conditioning=False')
+    parser.add_argument('--output_dir', default='logs/fused/',
+        help='Folder for the checkpoint to be used with fused_gate and shared_conditioning from hparams.py')
+
+    args = parser.parse_args()
+    convert(args, hparams)
+
+if __name__ == '__main__':
+    main()
@@ -6,9 +6,18 @@ import numpy as np
 hparams = tf.contrib.training.HParams(
     num_gpus = 1, #Determines the number of gpus in use
     ps_device_type = 'GPU', # 'CPU'/'GPU'  Where gradients will sync
+    all_reduce = '', # ''/'ring'/'hd'  Average gradients per variable on the ps device, or all-reduce fused buckets across gpus (ring or recursive halving-doubling)
+    all_reduce_bucket_mb = 32, #Size of the buckets gradients are fused into for all_reduce
+    accumulate_steps = 1, #Micro-batches whose gradients are summed for every optimizer step, the effective batch is batch_size * accumulate_steps
+    pipeline_stages = 1, #Devices (/gpu:0, /gpu:1, ...) the Blocks of a single tower are split over by their estimated cost, 1 disables
+    pipeline_micro_batches = 4, #Micro-batches every batch is split into for pipeline_stages > 1, has to divide batch_size
     dtype=tf.float16,
     scale=64.,
 #     scale=1.,
+    xla = '', # ''/'global'/'flow'  XLA JIT compilation of the whole graph or of every Flow separately
+    xla_bucket_frames = 50, #With xla, synthesis pads mels to a multiple of this many frames so that only a few lengths are compiled
+    dynamic_loss_scale = False, #Start from `scale`, halve it and skip the step on inf/nan gradients
+    loss_scale_window = 2000, #Steps without overflow after which a dynamic loss scale is doubled
 
     #Audio
     num_mels = 80, #Number of mel-spectrogram channels and local conditioning dimensionality
@@ -25,6 +34,14 @@ hparams = tf.contrib.training.HParams(
     fmin = 125, #Set this to 75 if your speaker is male! if female, 125 should help taking off noise. (To test depending on dataset)
     fmax = 4000,
     
+    dataset_backend = 'tfrecord', #'tfrecord' or 'numpy' to train from memory-mapped .npy files without creating tfrecords
+    mel_on_the_fly = False, #Compute mels from the audio in the input pipeline instead of storing them
+    tfrecord_version = 2, #1 stores audio and mel as FloatLists, 2 as raw little-endian bytes (both can be read)
+    tfrecord_pcm16 = False, #Store audio as int16 PCM in version 2 records
+    tfrecord_chunk_frames = 100, #Utterances are stored as overlapping records of this many frames so that only data around the crop is decoded, 0 stores whole utterances
+    tfrecord_shards = 32, #Number of files the training set is split into, written in parallel
+    tfrecord_compression = '', #'' (none), 'GZIP' or 'ZLIB', needs to match the compression of existing tfrecords
+    
     max_time_steps = 2320,
     
     eval_max_time_steps = 22050 * 4,
@@ -43,6 +60,11 @@ hparams = tf.contrib.training.HParams(
     n_flow = 6,
     n_layer = 2,
     affine = True,
+    fused_gate = False, #Single dilated and conditioning conv for filter and gate in ResBlock (convert old checkpoints with fuse_checkpoint.py)
+    shared_conditioning = False, #One conditioning projection per WaveNet shared by all of its ResBlocks (convert old checkpoints with fuse_checkpoint.py)
+    cin_bottleneck = 0, #Even number of conditioning channels every Block projects its squeezed conditioning to, 0 keeps doubling them
+    reversible = False, #Recompute the activations of every Flow from its output in the backward pass instead of storing them
+    checkpoint_flows = 0, #Keep only the inputs of every N flows for the backward pass and recompute the rest (n_flow keeps Block boundaries), 0 disables
     causality = False,
     tf_random_seed = 75,
     temp = 0.7,
@@ -1,7 +1,9 @@
 import tensorflow as tf
+from contextlib import contextmanager
 from modules import WaveNet
-from math import log, pi
-from convolutional import Conv2DTranspose
+from math import log, pi, ceil, gcd
+from convolutional import Conv1D, Conv2DTranspose
+from utils import with_custom_gradient
 
 
 class ActNorm:
@@ -83,30 +85,42 @@ class ActNorm:
         return x, dlogdet
 
 
-    def forward(self, x):
+    def forward(self, x, init=None):
+        init = self._init if init is None else init
         with tf.variable_scope(self._vs, auxiliary_name_scope=False) as vs1:
             with tf.name_scope(vs1.original_name_scope):
-                x = self.actnorm_center(x, reverse=False, init=self._init)
-                x, objective = self.actnorm_scale(x, reverse=False, init=self._init)
+                x = self.actnorm_center(x, reverse=False, init=init)
+                x, objective = self.actnorm_scale(x, reverse=False, init=init)
                 if self._logdet:
                     return x, objective
                 else:
                     return x
                     
 
-    def reverse(self, x):
+    def reverse(self, x, init=None):
+        init = self._init if init is None else init
         with tf.variable_scope(self._vs, auxiliary_name_scope=False) as vs1:
             with tf.name_scope(vs1.original_name_scope):
-                output, objective = self.actnorm_scale(x, reverse=True, init=self._init)
-                output = self.actnorm_center(output, reverse=True, init=self._init)
+                output, objective = self.actnorm_scale(x, reverse=True, init=init)
+                output = self.actnorm_center(output, reverse=True, init=init)
                 return output
 
+    def reverse_params(self):
+        """Returns (log_scale, shift) such that reverse(x) == x * exp(log_scale) + shift."""
+        with tf.variable_scope(self._vs, auxiliary_name_scope=False) as vs1:
+            with tf.name_scope(vs1.original_name_scope):
+                var_shape = (1, 1, self._in_channel)
+                logs = self.get_variable_ddi('logs', var_shape, initial_value=None, init=False)
+                b = self.get_variable_ddi('b', var_shape, initial_value=None, init=False)
+                return -logs * self._logscale, -b
+
     def __call__(self, x):
         return self.forward(x)
 
 
 class AffineCoupling:
-    def __init__(self, in_channel, cin_channel, filter_size=256, num_layer=6, affine=True, causal=False, scope='AffineCoupling', training_dtype=tf.float32):
+    def __init__(self, in_channel, cin_channel, filter_size=256, num_layer=6, affine=True, causal=False, scope='AffineCoupling', training_dtype=tf.float32,
+                 fused_gate=False, shared_conditioning=False):
         with tf.variable_scope(scope) as vs:
             self._vs = vs
             self._scope = scope
@@ -115,7 +129,8 @@ class AffineCoupling:
             self._net = WaveNet(in_channels=in_channel // 2, out_channels=in_channel if self._affine else in_channel // 2,
                             num_blocks=1, num_layers=num_layer, residual_channels=filter_size,
                             gate_channels=filter_size, skip_channels=filter_size,
-                            kernel_size=3, cin_channels=cin_channel // 2, causal=causal, training_dtype=training_dtype)
+                            kernel_size=3, cin_channels=cin_channel // 2, causal=causal, training_dtype=training_dtype,
+                            fused_gate=fused_gate, shared_conditioning=shared_conditioning)
                             
 
     def forward(self, x, c, g=None):
@@ -160,6 +175,29 @@ class AffineCoupling:
 
                 return tf.concat([out_a, in_b], 2)
 
+    def reverse_fused(self, out_a, out_b, c_a, g_a, log_scale, shift):
+        """Inverse of the coupling followed by the reverse of an ActNorm (see ActNorm.reverse_params).
+
+        The ActNorm affine of the second half is folded into the output conv of the coupling
+        network, so only the half passed through unchanged is scaled and shifted explicitly.
+        """
+        with tf.variable_scope(self._vs, auxiliary_name_scope=False) as vs1:
+            with tf.name_scope(vs1.original_name_scope):
+                log_scale_a, log_scale_b = tf.split(log_scale, axis=2, num_or_size_splits=2)
+                shift_a, shift_b = tf.split(shift, axis=2, num_or_size_splits=2)
+
+                if self._affine:
+                    # exp(log_s) * scale_b == exp(log_s + log_scale_b), t * scale_b + shift_b
+                    out_scale = tf.concat([tf.ones_like(log_scale_b), tf.exp(log_scale_b)], 2)
+                    out_shift = tf.concat([log_scale_b, shift_b], 2)
+                    log_s, t = tf.split(self._net(out_a, c_a, g_a, out_scale, out_shift), axis=2, num_or_size_splits=2)
+                    in_b = out_b * tf.exp(log_s) + t
+                else:
+                    net_out = self._net(out_a, c_a, g_a, -tf.exp(log_scale_b), shift_b)
+                    in_b = out_b * tf.exp(log_scale_b) + net_out
+
+                return out_a * tf.exp(log_scale_a) + shift_a, in_b
+
     def __call__(self, x, c, g=None):
         return self.forward(x, c, g)
 
@@ -173,19 +211,114 @@ def change_order(x, c, g=None):
 
     return tf.concat([x_b, x_a], 2), tf.concat([c_b, c_a], 2), None
 
+def receptive_field(hparams, kernel_size=3):
+    """One-sided context of FloWaveNet.reverse in mel frames.
+
+    Every Flow runs a WaveNet with a front conv of width 3 and `n_layer` ResBlocks
+    with dilations kernel_size ** n. Block k works on 2 ** (k + 1) squeezed samples,
+    and every upsample stage looks at most one of its input steps around.
+    """
+    pad = (lambda d: d * (kernel_size - 1)) if hparams.causality else (lambda d: d * (kernel_size - 1) // 2)
+    wavenet = pad(1) + sum(pad(kernel_size ** n) for n in range(hparams.n_layer))
+    samples = sum(hparams.n_flow * wavenet * 2 ** (k + 1) for k in range(hparams.n_block))
+    return int(ceil(samples / hparams.hop_size)) + len(hparams.upsample_scales)
+
+
+def frame_alignment(hparams):
+    """Smallest frame step for which a window of mel frames can be squeezed n_block times."""
+    squeeze = 2 ** hparams.n_block
+    return squeeze // gcd(hparams.hop_size, squeeze)
+
+
+def block_costs(hparams, filter_size=256, kernel_size=3):
+    """Multiply-adds of the convolutions of every Block per sample of audio.
+
+    Block k runs its Flows on 2 ** (k + 1) times fewer steps than there are samples, with
+    2 ** k input channels and half of its conditioning channels in every WaveNet.
+    """
+    costs = []
+    cin_channels = hparams.num_mels
+    for k in range(hparams.n_block):
+        in_half = 2 ** k
+        cin = hparams.cin_bottleneck if hparams.cin_bottleneck > 0 else cin_channels * 2
+        wavenet = (kernel_size * in_half * filter_size
+                   + hparams.n_layer * (kernel_size * filter_size * 2 * filter_size + cin // 2 * 2 * filter_size
+                                        + 2 * filter_size * filter_size)
+                   + filter_size * filter_size + filter_size * 2 * in_half)
+        cost = hparams.n_flow * wavenet
+        if hparams.cin_bottleneck > 0:
+            cost += cin_channels * 2 * cin
+        costs.append(cost / 2 ** (k + 1))
+        cin_channels = cin
+    return costs
+
+
+def partition_blocks(costs, num_stages):
+    """Splits consecutive Blocks into `num_stages` contiguous stages with the smallest cost of the
+    most expensive stage. Returns the stage of every Block."""
+    n = len(costs)
+    if not 0 < num_stages <= n:
+        raise ValueError('Cannot split {} Blocks into {} stages'.format(n, num_stages))
+
+    prefix = [0]
+    for cost in costs:
+        prefix.append(prefix[-1] + cost)
+
+    # best[s][i]: smallest maximal stage cost of the first i Blocks in s stages, split[s][i]: start of the last stage
+    best = [[float('inf')] * (n + 1) for _ in range(num_stages + 1)]
+    split = [[0] * (n + 1) for _ in range(num_stages + 1)]
+    best[0][0] = 0
+    for s in range(1, num_stages + 1):
+        for i in range(s, n + 1):
+            for j in range(s - 1, i):
+                cost = max(best[s - 1][j], prefix[i] - prefix[j])
+                if cost < best[s][i]:
+                    best[s][i], split[s][i] = cost, j
+
+    stages = [0] * n
+    end = n
+    for s in range(num_stages, 0, -1):
+        start = split[s][end]
+        stages[start:end] = [s - 1] * (end - start)
+        end = start
+    return stages
+
+
+@contextmanager
+def _jit_scope(enabled):
+    """Compiles the ops created in the scope and their gradients with XLA if `enabled`."""
+    if enabled:
+        with tf.contrib.compiler.jit.experimental_jit_scope(compile_ops=True, separate_compiled_gradients=True):
+            yield
+    else:
+        yield
+
+
+@contextmanager
+def _device(device):
+    """tf.device(device), or the enclosing device scope if `device` is None."""
+    if device is None:
+        yield
+    else:
+        with tf.device(device):
+            yield
+
 class Flow:
-    def __init__(self, in_channel, cin_channel, filter_size, num_layer, init, affine=True, causal=False, scope='Flow', training_dtype=tf.float32):
+    def __init__(self, in_channel, cin_channel, filter_size, num_layer, init, affine=True, causal=False, scope='Flow', training_dtype=tf.float32,
+                 fused_gate=False, shared_conditioning=False, jit=False):
         with tf.variable_scope(scope) as vs:
             self._vs = vs
             self._scope = scope
+            self._jit = jit
             self._actnorm = ActNorm(in_channel, init=init, training_dtype=training_dtype)
             self._coupling = AffineCoupling(in_channel, cin_channel, filter_size=filter_size,
-                                       num_layer=num_layer, affine=affine, causal=causal, training_dtype=training_dtype)
+                                       num_layer=num_layer, affine=affine, causal=causal, training_dtype=training_dtype,
+                                       fused_gate=fused_gate, shared_conditioning=shared_conditioning)
 
-    def forward(self, x, c, g=None):
+    def forward(self, x, c, g=None, init=None):
         with tf.variable_scope(self._vs, auxiliary_name_scope=False) as vs1:
-            with tf.name_scope(vs1.original_name_scope):
-                out, logdet = self._actnorm(x)
+            with tf.name_scope(vs1.original_name_scope), _jit_scope(self._jit):
+                out, logdet = self._actnorm.forward(x, init=init)
                 out, det = self._coupling(out, c, g)
                 out, c, g = change_order(out, c, g)
                 if det is not None:
@@ -193,32 +326,62 @@ class Flow:
 
                 return out, c, g, logdet
 
-    def reverse(self, output, c, g=None):
+    def reverse(self, output, c, g=None, init=None):
         with tf.variable_scope(self._vs, auxiliary_name_scope=False) as vs1:
-            with tf.name_scope(vs1.original_name_scope):
+            with tf.name_scope(vs1.original_name_scope), _jit_scope(self._jit):
                 output, c, g = change_order(output, c, g)
                 x = self._coupling.reverse(output, c, g)
-                x = self._actnorm.reverse(x)
+                x = self._actnorm.reverse(x, init=init)
                 return x, c, g
 
+    def reverse_fused(self, x_a, x_b, c_a, c_b, g_a=None, g_b=None):
+        """Same as reverse, but on tensors split into halves.
+
+        change_order becomes a swap of the halves and the ActNorm is merged into
+        the coupling, so no full-size copies or elementwise passes are made.
+        """
+        with tf.variable_scope(self._vs, auxiliary_name_scope=False) as vs1:
+            with tf.name_scope(vs1.original_name_scope), _jit_scope(self._jit):
+                out_a, out_b = x_b, x_a
+                c_a, c_b = c_b, c_a
+                g_a, g_b = g_b, g_a
+
+                log_scale, shift = self._actnorm.reverse_params()
+                x_a, x_b = self._coupling.reverse_fused(out_a, out_b, c_a, g_a, log_scale, shift)
+                return x_a, x_b, c_a, c_b, g_a, g_b
+
     def __call__(self, x, c, g=None):
         return self.forward(x, c, g)
 
 class Block:
-    def __init__(self, in_channel, cin_channel, n_flow, n_layer, init, affine=True, causal=False, scope='Block', training_dtype=tf.float32):
+    def __init__(self, in_channel, cin_channel, n_flow, n_layer, init, affine=True, causal=False, scope='Block', training_dtype=tf.float32,
+                 fused_gate=False, shared_conditioning=False, cin_bottleneck=0, reversible=False, checkpoint_flows=0, jit=False):
         with tf.variable_scope(scope) as vs:
             self._vs = vs
             self._scope = scope
+            self._cin_bottleneck = cin_bottleneck
+            self._reversible = reversible
+            self._checkpoint_flows = checkpoint_flows
             squeeze_dim = in_channel * 2
             squeeze_dim_c = cin_channel * 2
 
+            if self._cin_bottleneck > 0:
+                # Projects the squeezed conditioning to a fixed number of channels instead of doubling it
+                self._bottleneck_conv = Conv1D(filters=cin_bottleneck,
+                                               kernel_size=1,
+                                               kernel_initializer=tf.initializers.he_uniform(),
+                                               bias_initializer=tf.initializers.zeros(),
+                                               name='conv_bottleneck')
+                squeeze_dim_c = cin_bottleneck
+
             self._flows = []
             for i in range(n_flow):
                 self._flows.append(Flow(squeeze_dim, squeeze_dim_c, init=init, filter_size=256, num_layer=n_layer, affine=affine,
-                                    causal=causal, scope='Flow_%d' % i, training_dtype=training_dtype))
+                                    causal=causal, scope='Flow_%d' % i, training_dtype=training_dtype, fused_gate=fused_gate,
+                                    shared_conditioning=shared_conditioning, jit=jit))
                 
 
-    def forward(self, x, c, g=None):
+    def forward(self, x, c, g=None, init=None):
         with tf.variable_scope(self._vs, auxiliary_name_scope=False) as vs1:
             with tf.name_scope(vs1.original_name_scope):
                 shape = tf.shape(x)
@@ -227,10 +390,7 @@ class Block:
                     squeezed_x = tf.transpose(squeezed_x, [0, 1, 3, 2])
                     out = tf.reshape(squeezed_x, [shape[0], shape[1] // 2, 2 * x.shape[2]])
 
-                with tf.name_scope('squeeze_c'):
-                    squeezed_c = tf.reshape(c, [shape[0], shape[1] // 2, 2, c.shape[2]])
-                    squeezed_c = tf.transpose(squeezed_c, [0, 1, 3, 2])
-                    c = tf.reshape(squeezed_c, [shape[0], shape[1] // 2, 2 * c.shape[2]])
+                c = self.condition(c)
 
                 if g is not None:
                     with tf.name_scope('squeeze_g'):
@@ -238,14 +398,114 @@ class Block:
                         squeezed_g = tf.transpose(squeezed_g, [0, 1, 3, 2])
                         g = tf.reshape(squeezed_g, [shape[0], shape[1] // 2, 2 * g.shape[2]])
 
-                logdet = []
-                for flow in self._flows:
-                    out, c, g, det = flow(out, c, g)
-                    logdet.append(det)
+                if self._reversible:
+                    out, c, g, logdet = self._forward_flows_reversible(out, c, g, init=init)
+                elif self._checkpoint_flows > 0:
+                    logdet = []
+                    for i in range(0, len(self._flows), self._checkpoint_flows):
+                        flows = self._flows[i:i + self._checkpoint_flows]
+                        out, c, g, det = self._forward_flows_checkpointed(flows, out, c, g, init=init)
+                        logdet.append(det)
+                    logdet = tf.add_n(logdet)
+                else:
+                    out, c, g, logdet = self._forward_flows(out, c, g, init=init)
 
-                logdet = tf.add_n(logdet)  
                 return out, c, g, logdet
 
+    def _forward_flows(self, out, c, g=None, flows=None, init=None):
+        logdet = []
+        for flow in (self._flows if flows is None else flows):
+            out, c, g, det = flow.forward(out, c, g, init=init)
+            logdet.append(det)
+
+        logdet = tf.add_n(logdet)  
+        return out, c, g, logdet
+
+    def _forward_flows_checkpointed(self, flows, x, c, g=None, init=None):
+        """Same as _forward_flows on a segment of Flows, but only the input of the segment is kept
+        and its activations are recomputed in the backward pass."""
+        out, c_out, g_out, logdet = self._forward_flows(x, c, g, flows, init=init)
+        variables = [v for flow in flows for v in tf.trainable_variables(flow._vs.name + '/')]
+
+        def grad_fn(inputs, outputs, grad_outputs):
+            # Without the dependency the recomputation could run as soon as the inputs exist,
+            # during the forward pass, and keep its activations until the backward pass
+            with tf.name_scope('recompute'), tf.control_dependencies([d for d in grad_outputs if d is not None]):
+                xs = [tf.stop_gradient(t) for t in inputs]
+                out_re, c_re, g_re, logdet_re = self._forward_flows(xs[0], xs[1], xs[2] if g is not None else None, flows, init=False)
+
+                ys = [out_re, logdet_re, c_re] + ([g_re] if g is not None else [])
+                grad_ys = [d if d is not None else tf.zeros_like(t) for d, t in zip(grad_outputs, outputs)]
+                grads = tf.gradients(ys, xs + variables, grad_ys=grad_ys)
+                return grads[:len(xs)], grads[len(xs):]
+
+        inputs = [x, c] + ([g] if g is not None else [])
+        outputs = [out, logdet, c_out] + ([g_out] if g is not None else [])
+        outputs = with_custom_gradient(inputs, variables, outputs, grad_fn)
+        return outputs[0], outputs[2], outputs[3] if g is not None else None, outputs[1]
+
+    def _forward_flows_reversible(self, x, c, g=None, init=None):
+        """Same as _forward_flows, but the backward pass rebuilds the input of every Flow from
+        its output with Flow.reverse and recomputes that Flow alone, instead of keeping the
+        activations of all Flows."""
+        out, c_out, g_out, logdet = self._forward_flows(x, c, g, init=init)
+
+        flow_variables = [tf.trainable_variables(flow._vs.name + '/') for flow in self._flows]
+        variables = [v for flow_vars in flow_variables for v in flow_vars]
+
+        def grad_fn(inputs, outputs, grad_outputs):
+            y, _, c_y = outputs[:3]
+            g_y = outputs[3] if g is not None else None
+            dy, dlogdet, dc = [d if d is not None else tf.zeros_like(t) for d, t in zip(grad_outputs[:3], outputs[:3])]
+            if g is not None:
+                dg = grad_outputs[3] if grad_outputs[3] is not None else tf.zeros_like(g_y)
+
+            grad_vars = []
+            for flow, flow_vars in zip(self._flows[::-1], flow_variables[::-1]):
+                # Every Flow is rebuilt once the gradient of the Flow above is there, otherwise the
+                # whole chain could run during the forward pass and keep all its activations
+                deps = [dy, dc] + ([dg] if g is not None else [])
+                with tf.name_scope('recompute'), tf.control_dependencies(deps):
+                    x_re, c_x, g_x = flow.reverse(y, c_y, g_y, init=False)
+                    x_re, c_x = tf.stop_gradient(x_re), tf.stop_gradient(c_x)
+                    g_x = tf.stop_gradient(g_x) if g is not None else None
+
+                    y_re, c_re, g_re, det = flow.forward(x_re, c_x, g_x, init=False)
+
+                    ys, xs, grad_ys = [y_re, det, c_re], [x_re, c_x], [dy, dlogdet, dc]
+                    if g is not None:
+                        ys, xs, grad_ys = ys + [g_re], xs + [g_x], grad_ys + [dg]
+
+                    grads = tf.gradients(ys, xs + flow_vars, grad_ys=grad_ys)
+                    dy, dc = grads[0], grads[1]
+                    if g is not None:
+                        dg = grads[2]
+                    grad_vars = grads[len(xs):] + grad_vars
+
+                y, c_y, g_y = x_re, c_x, g_x
+
+            grad_inputs = [dy, dc] + ([dg] if g is not None else [])
+            return grad_inputs, grad_vars
+
+        inputs = [x, c] + ([g] if g is not None else [])
+        outputs = [out, logdet, c_out] + ([g_out] if g is not None else [])
+        outputs = with_custom_gradient(inputs, variables, outputs, grad_fn)
+        return outputs[0], outputs[2], outputs[3] if g is not None else None, outputs[1]
+
+    def condition(self, c):
+        """Squeezes the conditioning of the previous Block (or the upsampled mel) for this Block."""
+        with tf.variable_scope(self._vs, auxiliary_name_scope=False) as vs1:
+            with tf.name_scope(vs1.original_name_scope):
+                shape = tf.shape(c)
+                with tf.name_scope('squeeze_c'):
+                    squeezed_c = tf.reshape(c, [shape[0], shape[1] // 2, 2, c.shape[2]])
+                    squeezed_c = tf.transpose(squeezed_c, [0, 1, 3, 2])
+                    c = tf.reshape(squeezed_c, [shape[0], shape[1] // 2, 2 * c.shape[2]])
+
+                if self._cin_bottleneck > 0:
+                    c = self._bottleneck_conv(c)
+                return c
+
     def reverse(self, output, c, g=None):
         with tf.variable_scope(self._vs, auxiliary_name_scope=False) as vs1:
             with tf.name_scope(vs1.original_name_scope):
@@ -254,27 +514,49 @@ class Block:
                 for flow in self._flows[::-1]:
                     x, c, g = flow.reverse(x, c, g)
 
-                shape = tf.shape(x)
+                # The bottleneck projection can't be undone, FloWaveNet.reverse keeps the conditioning of every Block
+                return self._unsqueeze(x, c if self._cin_bottleneck <= 0 else None, g)
 
-                with tf.name_scope('unsqueezed_x'):
-                    unsqueezed_x = tf.reshape(x, [shape[0], shape[1], x.shape[2] // 2, 2])
-                    unsqueezed_x = tf.transpose(unsqueezed_x, [0, 1, 3, 2])
-                    unsqueezed_x = tf.reshape(unsqueezed_x, [shape[0], shape[1] * 2, x.shape[2] // 2])
+    def reverse_fused(self, output, c, g=None):
+        with tf.variable_scope(self._vs, auxiliary_name_scope=False) as vs1:
+            with tf.name_scope(vs1.original_name_scope):
+                x_a, x_b = tf.split(output, axis=2, num_or_size_splits=2)
+                c_a, c_b = tf.split(c, axis=2, num_or_size_splits=2)
+                g_a, g_b = tf.split(g, axis=2, num_or_size_splits=2) if g is not None else (None, None)
 
-                with tf.name_scope('unsqueezed_c'):
-                    unsqueezed_c = tf.reshape(c, [shape[0], shape[1], c.shape[2] // 2, 2])
-                    unsqueezed_c = tf.transpose(unsqueezed_c, [0, 1, 3, 2])
-                    unsqueezed_c = tf.reshape(unsqueezed_c, [shape[0], shape[1] * 2, c.shape[2] // 2])
+                for flow in self._flows[::-1]:
+                    x_a, x_b, c_a, c_b, g_a, g_b = flow.reverse_fused(x_a, x_b, c_a, c_b, g_a, g_b)
+
+                x = tf.concat([x_a, x_b], 2)
+                c = tf.concat([c_a, c_b], 2) if self._cin_bottleneck <= 0 else None
+                g = tf.concat([g_a, g_b], 2) if g is not None else None
+                return self._unsqueeze(x, c, g)
+
+    def _unsqueeze(self, x, c, g=None):
+        shape = tf.shape(x)
+
+        with tf.name_scope('unsqueezed_x'):
+            unsqueezed_x = tf.reshape(x, [shape[0], shape[1], x.shape[2] // 2, 2])
+            unsqueezed_x = tf.transpose(unsqueezed_x, [0, 1, 3, 2])
+            unsqueezed_x = tf.reshape(unsqueezed_x, [shape[0], shape[1] * 2, x.shape[2] // 2])
+
+        if c is not None:
+            with tf.name_scope('unsqueezed_c'):
+                unsqueezed_c = tf.reshape(c, [shape[0], shape[1], c.shape[2] // 2, 2])
+                unsqueezed_c = tf.transpose(unsqueezed_c, [0, 1, 3, 2])
+                unsqueezed_c = tf.reshape(unsqueezed_c, [shape[0], shape[1] * 2, c.shape[2] // 2])
+        else:
+            unsqueezed_c = None
 
-                if g is not None:
-                    with tf.name_scope('unsqueezed_g'):
-                        unsqueezed_g = tf.reshape(g, [shape[0], shape[1], g.shape[2] // 2, 2])
-                        unsqueezed_g = tf.transpose(unsqueezed_g, [0, 1, 3, 2])
-                        unsqueezed_g = tf.reshape(unsqueezed_g, [shape[0], shape[1] * 2, g.shape[2] // 2])
-                else:
-                    unsqueezed_g = None
-                    
-                return unsqueezed_x, unsqueezed_c, unsqueezed_g
+        if g is not None:
+            with tf.name_scope('unsqueezed_g'):
+                unsqueezed_g = tf.reshape(g, [shape[0], shape[1], g.shape[2] // 2, 2])
+                unsqueezed_g = tf.transpose(unsqueezed_g, [0, 1, 3, 2])
+                unsqueezed_g = tf.reshape(unsqueezed_g, [shape[0], shape[1] * 2, g.shape[2] // 2])
+        else:
+            unsqueezed_g = None
+            
+        return unsqueezed_x, unsqueezed_c, unsqueezed_g
 
     def __call__(self, x, c, g=None):
         return self.forward(x, c, g)
@@ -287,16 +569,22 @@ class FloWaveNet:
             self._blocks = []
             self._n_block = hparams.n_block
             self._cin_channels = hparams.num_mels
+            self._cin_bottleneck = hparams.cin_bottleneck
             self._hparams = hparams
             self._dtype = hparams.dtype
+            if hparams.xla not in ['', 'global', 'flow']:
+                raise ValueError("xla has to be '', 'global' or 'flow', got {!r}".format(hparams.xla))
 
             in_channels = 1
             cin_channels = self._cin_channels
             for i in range(self._n_block):
                 self._blocks.append(Block(in_channels, cin_channels, hparams.n_flow, hparams.n_layer, init=init, affine=hparams.affine,
-                                        causal=hparams.causality, scope='Block_%d' % i, training_dtype=self._dtype))
+                                        causal=hparams.causality, scope='Block_%d' % i, training_dtype=self._dtype,
+                                        fused_gate=hparams.fused_gate, shared_conditioning=hparams.shared_conditioning,
+                                        cin_bottleneck=self._cin_bottleneck, reversible=hparams.reversible,
+                                        checkpoint_flows=hparams.checkpoint_flows, jit=hparams.xla == 'flow'))
                 in_channels *= 2
-                cin_channels *= 2
+                cin_channels = cin_channels * 2 if self._cin_bottleneck <= 0 else self._cin_bottleneck
 
             self._upsample_conv = []
             for s in hparams.upsample_scales:
@@ -314,40 +602,80 @@ class FloWaveNet:
                 self.speaker_embeddings = tf.get_variable('speaker_embeddings', [hparams.n_speakers, hparams.gin_channels], dtype=tf.float32)
                 
                 
-    def forward(self, x, c, g=None):
+    def forward(self, x, c, g=None, block_devices=None, init=None):
+        """Returns log_p and logdet of x. `block_devices` optionally places every Block on a device,
+        the upsampling runs on the device of the first Block and the loss on the last. `init`
+        overrides the ActNorm initialization flag the model was built with."""
+        block_devices = block_devices or [None] * self._n_block
         with tf.variable_scope(self._vs, auxiliary_name_scope=False) as vs1:
             with tf.name_scope(vs1.original_name_scope):
                 if g is None and self._hparams.gin_channels > 0:
                     raise ValueError('g is None')
                     
-                x = tf.cast(x, dtype=self._dtype) if x.dtype != self._dtype else x
-                c = tf.cast(c, dtype=self._dtype) if c.dtype != self._dtype else c
-
-                logdet = []
-                out = x
-                c = self.upsample(c)
-
-                if g is not None and self._hparams.gin_channels > 0:
-                    g_embeddings = tf.nn.embedding_lookup(self.speaker_embeddings, g)
-                    g_embeddings = tf.cast(g_embeddings, dtype=self._dtype) if g_embeddings.dtype != self._dtype else g_embeddings
-                    g_embeddings = tf.expand_dims(g_embeddings, axis=1)
-                    g_embeddings = tf.tile(g_embeddings, (1, tf.shape(c)[1], 1))
-                else:
-                    g_embeddings = None
+                with _device(block_devices[0]):
+                    x = tf.cast(x, dtype=self._dtype) if x.dtype != self._dtype else x
+                    c = tf.cast(c, dtype=self._dtype) if c.dtype != self._dtype else c
+
+                    logdet = []
+                    out = x
+                    c = self.upsample(c)
+
+                    if g is not None and self._hparams.gin_channels > 0:
+                        g_embeddings = tf.nn.embedding_lookup(self.speaker_embeddings, g)
+                        g_embeddings = tf.cast(g_embeddings, dtype=self._dtype) if g_embeddings.dtype != self._dtype else g_embeddings
+                        g_embeddings = tf.expand_dims(g_embeddings, axis=1)
+                        g_embeddings = tf.tile(g_embeddings, (1, tf.shape(c)[1], 1))
+                    else:
+                        g_embeddings = None
                     
-                for block in self._blocks:
-                    out, c, g_embeddings, logdet_new = block(out, c, g_embeddings)
-                    logdet.append(logdet_new)
-
-                logdet = tf.add_n(logdet)
-                log_p = tf.reduce_mean(0.5 * (- log(2.0 * pi) - tf.pow(out, 2)))
+                for block, device in zip(self._blocks, block_devices):
+                    with _device(device):
+                        out, c, g_embeddings, logdet_new = block.forward(out, c, g_embeddings, init=init)
+                        logdet.append(logdet_new)
+
+                with _device(block_devices[-1]):
+                    logdet = tf.add_n(logdet)
+                    log_p = tf.reduce_mean(0.5 * (- log(2.0 * pi) - tf.pow(out, 2)))
                 
-                logdet = tf.cast(logdet, dtype=tf.float32)
-                log_p = tf.cast(log_p, dtype=tf.float32)
+                    logdet = tf.cast(logdet, dtype=tf.float32)
+                    log_p = tf.cast(log_p, dtype=tf.float32)
                 return log_p, logdet
 
+    def forward_pipelined(self, x, c, g=None, devices=None, num_micro_batches=1):
+        """Same as forward, with the Blocks split into contiguous stages on `devices`.
+
+        The stages are balanced by block_costs and the batch is split into `num_micro_batches`
+        micro-batches. Every micro-batch passes the stages in order, so while one stage works
+        on a micro-batch the previous stage already computes the next one (GPipe), and the
+        losses are the means over the micro-batches.
+
+        The micro-batches never run the data-dependent ActNorm initialization, each of them would
+        assign its own statistics. Run init_pipelined with the init flag set before the first step.
+        """
+        block_devices, xs, cs, gs = self._split_micro_batches(x, c, g, devices, num_micro_batches)
+        log_p, logdet = zip(*[self.forward(x_i, c_i, g_i, block_devices, init=False) for x_i, c_i, g_i in zip(xs, cs, gs)])
+        with tf.device(devices[-1]):
+            return tf.add_n(log_p) / num_micro_batches, tf.add_n(logdet) / num_micro_batches
+
+    def init_pipelined(self, x, c, g=None, devices=None, num_micro_batches=1):
+        """Data-dependent ActNorm initialization for forward_pipelined: forward on the first
+        micro-batch only, with the Blocks on the devices of their stages."""
+        block_devices, xs, cs, gs = self._split_micro_batches(x, c, g, devices, num_micro_batches)
+        return self.forward(xs[0], cs[0], gs[0], block_devices)
+
+    def _split_micro_batches(self, x, c, g, devices, num_micro_batches):
+        stages = partition_blocks(block_costs(self._hparams), len(devices))
+        block_devices = [devices[stage] for stage in stages]
+
+        with tf.name_scope('micro_batches'):
+            xs = tf.split(x, num_micro_batches)
+            cs = tf.split(c, num_micro_batches)
+            gs = tf.split(g, num_micro_batches) if g is not None else [None] * num_micro_batches
+        return block_devices, xs, cs, gs
+
             
-    def reverse(self, z, c, g=None):  
+    def reverse(self, z, c, g=None, fused=False):
+        """Inverts the flow. With fused=True every ActNorm is merged into its coupling (inference only)."""
         with tf.variable_scope(self._vs, auxiliary_name_scope=False) as vs1:
             with tf.name_scope(vs1.original_name_scope):
                 if g is None and self._hparams.gin_channels > 0:
@@ -366,6 +694,12 @@ class FloWaveNet:
                 else:
                     g_embeddings = None
 
+                if self._cin_bottleneck > 0:
+                    conditions = []
+                    for block in self._blocks:
+                        c = block.condition(c)
+                        conditions.append(c)
+
                 x = z
                 x_channels = 1
                 c_channels = self._cin_channels
@@ -377,9 +711,10 @@ class FloWaveNet:
                     x = tf.transpose(x, [0, 1, 3, 2])
                     x = tf.reshape(x, [shape[0], shape[1] // 2, 2 * x_channels])
                     
-                    c = tf.reshape(c, [shape[0], shape[1] // 2, 2, c_channels])
-                    c = tf.transpose(c, [0, 1, 3, 2])
-                    c = tf.reshape(c, [shape[0], shape[1]  // 2, 2 * c_channels])
+                    if self._cin_bottleneck <= 0:
+                        c = tf.reshape(c, [shape[0], shape[1] // 2, 2, c_channels])
+                        c = tf.transpose(c, [0, 1, 3, 2])
+                        c = tf.reshape(c, [shape[0], shape[1]  // 2, 2 * c_channels])
                     
                     if g_embeddings is not None:
                         g_embeddings = tf.reshape(g_embeddings, [shape[0], shape[1] // 2, 2, g_channels])
@@ -392,7 +727,13 @@ class FloWaveNet:
                     x_channels = x_channels * 2
 
                 for i, block in enumerate(self._blocks[::-1]):
-                    x, c, g_embeddings = block.reverse(x, c, g_embeddings)
+                    if self._cin_bottleneck > 0:
+                        c = conditions[self._n_block - 1 - i]
+
+                    if fused:
+                        x, c, g_embeddings = block.reverse_fused(x, c, g_embeddings)
+                    else:
+                        x, c, g_embeddings = block.reverse(x, c, g_embeddings)
                 return x
 
     def upsample(self, c):
@@ -48,20 +48,29 @@ class ZeroConv1d:
                                 
             self._scale = tf.get_variable('scale', shape=[1, 1, out_channel], initializer=tf.initializers.zeros(), dtype=training_dtype)
     
-    def forward(self, x):
+    def forward(self, x, out_scale=None, out_shift=None):
         with tf.variable_scope(self._vs, auxiliary_name_scope=False) as vs1:
             with tf.name_scope(vs1.original_name_scope):
                 out = self._conv(x)
-                out = out * tf.exp(self._scale * 3)
-                return out
-
-    def __call__(self, x):
-        return self.forward(x)
+                if out_scale is None:
+                    out = out * tf.exp(self._scale * 3)
+                    return out
+
+                # Per-channel affine of the output folded into the 1x1 kernel and the bias,
+                # the unfused output above is left out of the computation.
+                scale = tf.exp(self._scale * 3) * out_scale
+                kernel = self._conv.kernel * scale
+                bias = tf.reshape(self._conv.bias * scale + out_shift, [-1])
+                return tf.nn.bias_add(tf.nn.conv1d(x, kernel, 1, 'VALID'), bias)
+
+    def __call__(self, x, out_scale=None, out_shift=None):
+        return self.forward(x, out_scale, out_shift)
             
 
 class ResBlock:
     def __init__(self, in_channels, out_channels, skip_channels, kernel_size, dilation,
-                 cin_channels=None, local_conditioning=True, global_conditioning=True, causal=False, scope='ResBlock', training_dtype=tf.float32):
+                 cin_channels=None, local_conditioning=True, global_conditioning=True, causal=False, scope='ResBlock', training_dtype=tf.float32,
+                 fused_gate=False):
         with tf.variable_scope(scope) as vs:
             self._vs = vs
             self._scope = scope
@@ -71,9 +80,14 @@ class ResBlock:
             self._cin_channels = cin_channels
             self._skip = True if skip_channels is not None else False
             self._training_dtype=training_dtype
+            self._fused_gate = fused_gate
+
+            if self._fused_gate:
+                self._init_fused_gate(in_channels, out_channels, kernel_size, dilation, causal)
+            else:
+                self._filter_conv = Conv(in_channels, out_channels, kernel_size, dilation, causal, scope='Conv_filter')
+                self._gate_conv = Conv(in_channels, out_channels, kernel_size, dilation, causal, scope='Conv_gate')
 
-            self._filter_conv = Conv(in_channels, out_channels, kernel_size, dilation, causal, scope='Conv_filter')
-            self._gate_conv = Conv(in_channels, out_channels, kernel_size, dilation, causal, scope='Conv_gate')
             self._res_conv = Conv1D(filters=out_channels, 
                                               kernel_size=1,
                                               kernel_initializer=tf.initializers.he_uniform(),
@@ -85,7 +99,7 @@ class ResBlock:
                                                    kernel_initializer=tf.initializers.he_uniform(),
                                                    bias_initializer=tf.initializers.he_uniform())
 
-            if self._local_conditioning:
+            if self._local_conditioning and not self._fused_gate:
                 self._filter_conv_c = Conv1D(filters=out_channels, 
                                              kernel_size=1, 
                                              kernel_initializer=tf.initializers.he_uniform(),
@@ -96,7 +110,7 @@ class ResBlock:
                                            kernel_initializer=tf.initializers.he_uniform(),
                                            bias_initializer=tf.initializers.he_uniform())
 
-            if self._global_conditioning:
+            if self._global_conditioning and not self._fused_gate:
                 self._filter_conv_g = Conv1D(filters=out_channels, 
                                              kernel_size=1, 
                                              kernel_initializer=tf.initializers.he_uniform(),
@@ -107,19 +121,57 @@ class ResBlock:
                                            kernel_initializer=tf.initializers.he_uniform(),
                                            bias_initializer=tf.initializers.he_uniform())
 
-    def forward(self, tensor, c, g=None):
+    def _init_fused_gate(self, in_channels, out_channels, kernel_size, dilation, causal):
+        """Filter and gate convolutions merged into single layers with 2 * out_channels outputs."""
+        self._conv = Conv(in_channels, 2 * out_channels, kernel_size, dilation, causal, scope='Conv_fused')
+
+        if self._local_conditioning:
+            self._conv_c = Conv1D(filters=2 * out_channels,
+                                  kernel_size=1,
+                                  kernel_initializer=tf.initializers.he_uniform(),
+                                  bias_initializer=tf.initializers.he_uniform(),
+                                  name='conv_c')
+
+        if self._global_conditioning:
+            self._conv_g = Conv1D(filters=2 * out_channels,
+                                  kernel_size=1,
+                                  kernel_initializer=tf.initializers.he_uniform(),
+                                  bias_initializer=tf.initializers.he_uniform(),
+                                  name='conv_g')
+
+    def forward(self, tensor, c, g=None, h_c=None):
+        """`h_c` is an optional precomputed conditioning projection, filter and gate concatenated."""
         with tf.variable_scope(self._vs, auxiliary_name_scope=False) as vs1:
             with tf.name_scope(vs1.original_name_scope):
-                h_filter = self._filter_conv(tensor)
-                h_gate = self._gate_conv(tensor)
+                if self._fused_gate:
+                    h = self._conv(tensor)
+
+                    if self._local_conditioning:
+                        h += self._conv_c(c)
+
+                    if h_c is not None:
+                        h += h_c
 
-                if self._local_conditioning:
-                    h_filter += self._filter_conv_c(c)
-                    h_gate += self._gate_conv_c(c)
+                    if self._global_conditioning and g is not None:
+                        h += self._conv_g(g)
 
-                if self._global_conditioning and g is not None:
-                    h_filter += self._filter_conv_g(g)
-                    h_gate += self._gate_conv_g(g)
+                    h_filter, h_gate = tf.split(h, axis=2, num_or_size_splits=2)
+                else:
+                    h_filter = self._filter_conv(tensor)
+                    h_gate = self._gate_conv(tensor)
+
+                    if self._local_conditioning:
+                        h_filter += self._filter_conv_c(c)
+                        h_gate += self._gate_conv_c(c)
+
+                    if h_c is not None:
+                        h_c_filter, h_c_gate = tf.split(h_c, axis=2, num_or_size_splits=2)
+                        h_filter += h_c_filter
+                        h_gate += h_c_gate
+
+                    if self._global_conditioning and g is not None:
+                        h_filter += self._filter_conv_g(g)
+                        h_gate += self._gate_conv_g(g)
 
                 out = tf.tanh(h_filter) * tf.sigmoid(h_gate)
 
@@ -127,19 +179,21 @@ class ResBlock:
                 skip = self._skip_conv(out) if self._skip else None
                 return (tensor + res) * tf.cast(tf.sqrt(0.5), dtype=self._training_dtype), skip
 
-    def __call__(self, tensor, c, g=None):
-        return self.forward(tensor, c, g)
+    def __call__(self, tensor, c, g=None, h_c=None):
+        return self.forward(tensor, c, g, h_c)
 
 
 class WaveNet:
     def __init__(self, in_channels=1, out_channels=2, num_blocks=1, num_layers=6,
                  residual_channels=256, gate_channels=256, skip_channels=256,
-                 kernel_size=3, cin_channels=80, causal=True, scope='WaveNet', training_dtype=tf.float32):
+                 kernel_size=3, cin_channels=80, causal=True, scope='WaveNet', training_dtype=tf.float32, fused_gate=False,
+                 shared_conditioning=False):
 
         with tf.variable_scope(scope) as vs:
             self._vs = vs
             self._scope = scope
             self._skip = True if skip_channels is not None else False
+            self._shared_conditioning = shared_conditioning
 
             self._front_conv = Conv(in_channels, residual_channels, 3, causal=causal, scope='Conv_front')
             # self._front_conv = tf.nn.relu(self._front_conv)
@@ -150,42 +204,56 @@ class WaveNet:
                 for n in range(num_layers):
                     self._res_blocks.append(ResBlock(residual_channels, gate_channels, skip_channels,
                                                      kernel_size, dilation=kernel_size ** n,
-                                                     cin_channels=cin_channels, local_conditioning=True, global_conditioning=True,
-                                                     causal=causal, scope='ResBlock_%d_%d' % (b, n), training_dtype=training_dtype))
+                                                     cin_channels=cin_channels, local_conditioning=not shared_conditioning, global_conditioning=True,
+                                                     causal=causal, scope='ResBlock_%d_%d' % (b, n), training_dtype=training_dtype,
+                                                     fused_gate=fused_gate))
+
+            if self._shared_conditioning:
+                # The 1x1 conditioning convs of all ResBlocks as one wide conv, sliced per ResBlock
+                self._conv_c = Conv1D(filters=len(self._res_blocks) * 2 * gate_channels,
+                                      kernel_size=1,
+                                      kernel_initializer=tf.initializers.he_uniform(),
+                                      bias_initializer=tf.initializers.he_uniform(),
+                                      name='conv_c')
 
             last_channels = skip_channels if self._skip else residual_channels
 
             self._final_conv = Conv(last_channels, last_channels, 1, causal=causal, scope='Conv_final')
             self._final_zero_conv = ZeroConv1d(last_channels, out_channels, training_dtype=training_dtype)
 
-    def forward(self, x, c, g=None):
+    def forward(self, x, c, g=None, out_scale=None, out_shift=None):
         with tf.variable_scope(self._vs, auxiliary_name_scope=False) as vs1:
             with tf.name_scope(vs1.original_name_scope):
                 h = self._front_conv(x)
                 h = tf.nn.relu(h)
 
+                if self._shared_conditioning:
+                    h_c = tf.split(self._conv_c(c), axis=2, num_or_size_splits=len(self._res_blocks))
+                else:
+                    h_c = [None] * len(self._res_blocks)
+
                 skip = []
                 for i, f in enumerate(self._res_blocks):
                     if self._skip:
-                        h, s = f(h, c, g)
+                        h, s = f(h, c, g, h_c[i])
                         skip.append(s)
                     else:
-                        h, _ = f(h, c, g)
+                        h, _ = f(h, c, g, h_c[i])
 
                 if self._skip:
                     out = tf.add_n(skip)
                     out = tf.nn.relu(out)
                     out = self._final_conv(out)
                     out = tf.nn.relu(out)
-                    out = self._final_zero_conv(out)
+                    out = self._final_zero_conv(out, out_scale, out_shift)
                 else:
                     out = tf.nn.relu(h)
                     out = self._final_conv(out)
                     out = tf.nn.relu(out)
-                    out = self._final_zero_conv(out)
+                    out = self._final_zero_conv(out, out_scale, out_shift)
                 return out
 
-    def __call__(self, x, c, g=None):
-        return self.forward(x, c)
+    def __call__(self, x, c, g=None, out_scale=None, out_shift=None):
+        return self.forward(x, c, out_scale=out_scale, out_shift=out_shift)
 
 
@@ -1,20 +1,20 @@
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, Future
+from collections import deque
 from functools import partial
 import numpy as np
 import os
-import librosa
+import hashlib
 from multiprocessing import cpu_count
 import argparse
+import time
 from hparams import hparams
 from tqdm import tqdm
 from tfrecord import TFRecordCreator
+from audio import load_wav, melspectrogram, frame_padding
 
 
-def build_from_path(in_dir, out_dir, num_workers=1):
-    executor = ProcessPoolExecutor(max_workers=num_workers)
-    futures = []
-    index = 1
-    
+def _list_utterances(in_dir):
+    """Yields (speaker_id, wav_path, text) for every line of the metadata.csv files in `in_dir`."""
     if hparams.gin_channels > 0:
         speakers = [f for f in os.listdir(in_dir) if os.path.isdir(os.path.join(in_dir, f))]
         books = []
@@ -31,50 +31,114 @@ def build_from_path(in_dir, out_dir, num_workers=1):
                 
     for speaker_id, book in books:
         with open(os.path.join(book, 'metadata.csv'), encoding='utf-8') as f:
-            lines = f.read().strip().split('\n')
-            for line in lines:
-                parts = line.strip().split('|')
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                parts = line.split('|')
                 wav_path = os.path.join(book, 'wavs', '%s.wav' % parts[0])
                 try:
                     text = parts[2]
                 except:
                     print(os.path.join(book, 'metadata.csv'))
                     print(parts)
-                futures.append(executor.submit(
-                    partial(_process_utterance, out_dir, index, wav_path, text, speaker_id)))
-                index += 1
-    return [future.result() for future in tqdm(futures) if future.result() is not None]
-
-
-def _process_utterance(out_dir, index, wav_path, text, speaker_id):
-    wav, sr = librosa.load(wav_path, sr=hparams.sample_rate)
+                yield speaker_id, wav_path, text
+
+
+# hparams that change the content of the .npy files
+MANIFEST_HPARAMS = ['sample_rate', 'rescaling_max', 'n_fft', 'hop_size', 'num_mels', 'fmin', 'fmax',
+                    'ref_level_db', 'min_level_db', 'mel_on_the_fly']
+
+
+def _load_manifest(manifest_path):
+    """Maps source paths to [source, mtime, size, hparams digest, audio_filename, mel_filename, timesteps]."""
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding='utf-8') as f:
+            for line in f:
+                entry = line.rstrip('\n').split('|')
+                # A line cut short by a crash is ignored
+                if len(entry) == 7:
+                    manifest[entry[0]] = entry
+    return manifest
+
+
+def _pop_result(futures, manifest_file):
+    key, future = futures.popleft()
+    result = future.result()
+    if key is not None and result is not None:
+        manifest_file.write('|'.join(key + [result[0], result[1], str(result[2])]) + '\n')
+        manifest_file.flush()
+    return result
+
+
+def build_from_path(in_dir, out_dir, num_workers=1, max_in_flight=None):
+    """Yields the metadata of the processed utterances in corpus order.
+
+    At most `max_in_flight` utterances (4 per worker by default) are queued or being
+    processed at any time, so memory does not grow with the size of the corpus.
+
+    Processed utterances are appended to manifest.txt with the mtime and size of their
+    wav and a digest of the hparams used. Utterances found unchanged in the manifest are
+    not processed again, which also lets an interrupted run resume.
+    """
+    max_in_flight = max_in_flight or 4 * num_workers
+    futures = deque()
+
+    manifest_path = os.path.join(out_dir, 'manifest.txt')
+    manifest = _load_manifest(manifest_path)
+    # Audio for mel_on_the_fly is stored unpadded, older manifests stored it padded
+    values = [hparams.get(name) for name in MANIFEST_HPARAMS] + (['unpadded'] if hparams.mel_on_the_fly else [])
+    params = hashlib.sha1(repr(values).encode('utf-8')).hexdigest()[:16]
+    n_cached = 0
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor, \
+            open(manifest_path, 'a', encoding='utf-8') as manifest_file:
+        for speaker_id, wav_path, text in _list_utterances(in_dir):
+            source = os.path.relpath(wav_path, in_dir)
+            stat = os.stat(wav_path)
+            key = [source, str(stat.st_mtime_ns), str(stat.st_size), params]
+
+            entry = manifest.get(source)
+            if entry is not None and entry[:4] == key and os.path.exists(os.path.join(out_dir, 'audios', entry[4])):
+                # Text and speaker come from the current metadata.csv
+                future = Future()
+                future.set_result((entry[4], entry[5], int(entry[6]), speaker_id, text))
+                futures.append((None, future))
+                n_cached += 1
+            else:
+                # Output names only depend on the source path, adding data does not rename existing files
+                name = hashlib.sha1(source.encode('utf-8')).hexdigest()[:16]
+                futures.append((key, executor.submit(
+                    partial(_process_utterance, out_dir, name, wav_path, text, speaker_id))))
+
+            if len(futures) >= max_in_flight:
+                result = _pop_result(futures, manifest_file)
+                if result is not None:
+                    yield result
+
+        while futures:
+            result = _pop_result(futures, manifest_file)
+            if result is not None:
+                yield result
+
+    print('Reused %d unchanged utterances from %s' % (n_cached, manifest_path))
+
+
+def _process_utterance(out_dir, name, wav_path, text, speaker_id):
+    wav = load_wav(wav_path, hparams.sample_rate)
 
     wav = wav / np.abs(wav).max() * hparams.rescaling_max
     out = wav
     constant_values = 0.0
     out_dtype = np.float32
 
-    # Compute a mel-scale spectrogram from the trimmed wav:
-    # (N, D)
-    mel_spectrogram = librosa.feature.melspectrogram(wav, 
-                                                     sr=sr, 
-                                                     n_fft=hparams.n_fft, 
-                                                     hop_length=hparams.hop_size, 
-                                                     n_mels=hparams.num_mels, 
-                                                     fmin=hparams.fmin, 
-                                                     fmax=hparams.fmax).T
-
-    # mel_spectrogram = np.round(mel_spectrogram, decimals=2)
-    mel_spectrogram = 20 * np.log10(np.maximum(1e-4, mel_spectrogram)) - hparams.ref_level_db
-    mel_spectrogram = np.clip((mel_spectrogram - hparams.min_level_db) / (-hparams.min_level_db), 0, 1)
-
-    pad = (out.shape[0] // hparams.hop_size + 1) * hparams.hop_size - out.shape[0]
-    pad_l = pad // 2
-    pad_r = pad // 2 + pad % 2
+    pad_l, pad_r = frame_padding(out.shape[0], hparams)
 
     # zero pad for quantized signal
     out = np.pad(out, (pad_l, pad_r), mode="constant", constant_values=constant_values)
-    N = mel_spectrogram.shape[0]
+    # librosa's centered frames: one more than whole hops in the wav
+    N = len(wav) // hparams.hop_size + 1
     assert len(out) >= N * hparams.hop_size
 
     # time resolution adjustment
@@ -86,38 +150,65 @@ def _process_utterance(out_dir, index, wav_path, text, speaker_id):
     timesteps = len(out)
 
     # Write the spectrograms to disk:
-    audio_filename = 'dataset-audio-%05d.npy' % index
-    mel_filename = 'dataset-mel-%05d.npy' % index
+    audio_filename = 'dataset-audio-%s.npy' % name
+    mel_filename = 'dataset-mel-%s.npy' % name
+    # The input pipeline of mel_on_the_fly pads the wav itself (see audio.audio_with_context),
+    # its mels are computed from the wav like the mels below
     np.save(os.path.join(out_dir, 'audios', audio_filename),
-            out.astype(out_dtype), allow_pickle=False)
-    np.save(os.path.join(out_dir, 'mels', mel_filename),
-            mel_spectrogram.astype(np.float32), allow_pickle=False)
+            (wav if hparams.mel_on_the_fly else out).astype(out_dtype), allow_pickle=False)
+
+    # With mel_on_the_fly the input pipeline computes mels from the audio
+    if not hparams.mel_on_the_fly:
+        mel_spectrogram = melspectrogram(wav, hparams)
+        assert mel_spectrogram.shape[0] == N
+        np.save(os.path.join(out_dir, 'mels', mel_filename),
+                mel_spectrogram.astype(np.float32), allow_pickle=False)
 
     # Return a tuple describing this training example:
     return audio_filename, mel_filename, timesteps, speaker_id, text
 
 
-def preprocess(in_dir, out_dir, num_workers):
+def preprocess(in_dir, out_dir, num_workers, max_in_flight=None):
     os.makedirs(out_dir, exist_ok=True)
     os.makedirs(os.path.join(out_dir, 'audios'), exist_ok=True)
     os.makedirs(os.path.join(out_dir, 'mels'), exist_ok=True)
-    metadata = build_from_path(in_dir, out_dir, num_workers)
+    metadata = build_from_path(in_dir, out_dir, num_workers, max_in_flight)
     write_metadata(metadata, out_dir)
 
 
 def write_metadata(metadata, out_dir):
+    """Appends every row of `metadata` to train.txt as soon as it is available, keeping only running totals."""
+    n_utterances = 0
+    time_steps = 0
+    max_input_length = 0
+    max_output_length = 0
+    start_time = time.time()
+
     with open(os.path.join(out_dir, 'train.txt'), 'w', encoding='utf-8') as f:
-        for m in metadata:
+        progress = tqdm(metadata, unit='utt')
+        for m in progress:
             f.write('|'.join([str(x) for x in m]) + '\n')
-    frames = sum([m[2] for m in metadata])
-    hours = frames / hparams.sample_rate / 3600
-    print('Wrote %d utterances, %d time steps (%.2f hours)' % (len(metadata), frames, hours))
-    print('Max input length:  %d' % max(len(m[4]) for m in metadata))
-    print('Max output length: %d' % max(m[2] for m in metadata))
 
-    print('Creating tfrecords...')
-    creator = TFRecordCreator(os.path.join(out_dir, 'train.txt'), hparams)
-    creator.create_tfrecords()
+            n_utterances += 1
+            time_steps += m[2]
+            max_input_length = max(max_input_length, len(m[4]))
+            max_output_length = max(max_output_length, m[2])
+
+            duration = time.time() - start_time
+            progress.set_postfix_str('%.2f hours of audio/sec' % (time_steps / hparams.sample_rate / 3600 / max(duration, 1e-8)))
+
+    duration = time.time() - start_time
+    hours = time_steps / hparams.sample_rate / 3600
+    print('Wrote %d utterances, %d time steps (%.2f hours)' % (n_utterances, time_steps, hours))
+    print('Processed %.2f utterances/sec, %.4f hours of audio/sec' % (n_utterances / duration, hours / duration))
+    print('Max input length:  %d' % max_input_length)
+    print('Max output length: %d' % max_output_length)
+
+    # The numpy dataset backend reads the .npy files directly
+    if hparams.dataset_backend == 'tfrecord':
+        print('Creating tfrecords...')
+        creator = TFRecordCreator(os.path.join(out_dir, 'train.txt'), hparams)
+        creator.create_tfrecords()
 
 
 if __name__ == "__main__":
@@ -125,8 +216,10 @@ if __name__ == "__main__":
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('--in_dir', '-i', type=str, default='./', help='In Directory')
     parser.add_argument('--out_dir', '-o', type=str, default='./', help='Out Directory')
+    parser.add_argument('--max_in_flight', type=int, default=0,
+                        help='Utterances queued or being processed at once, 0 for 4 per worker')
     args = parser.parse_args()
 
     num_workers = cpu_count()
-    preprocess(args.in_dir, args.out_dir, num_workers)
+    preprocess(args.in_dir, args.out_dir, num_workers, args.max_in_flight)
     
@@ -1,63 +1,245 @@
 import tensorflow as tf
 import os
-from model import FloWaveNet
+from model import FloWaveNet, receptive_field, frame_alignment
 from hparams import hparams
 import argparse
+import time
+import wave
 import numpy as np
 from tqdm import tqdm
 import librosa
+from utils import fp16_dtype_getter, jit_config
+from math import gcd
+from audio import load_wav, melspectrogram
 
-def get_model(hparams):
-    with tf.variable_scope('vocoder'):
-        lc = tf.placeholder(tf.float32, shape=[None, None, hparams.num_mels])
+def get_model(hparams, fused=False):
+    with tf.variable_scope('vocoder', custom_getter=fp16_dtype_getter):
+        lc = tf.placeholder(tf.float32, shape=[None, None, hparams.num_mels], name='lc')
         shape = tf.shape(lc)
-        z = tf.random_normal([shape[0], shape[1] * hparams.hop_size, 1]) * hparams.temp
+        z = tf.placeholder_with_default(tf.random_normal([shape[0], shape[1] * hparams.hop_size, 1]) * hparams.temp,
+                                        shape=[None, None, 1], name='z')
 
         model = FloWaveNet(hparams, scope='FloWaveNet')
 
-        predictions = model.reverse(z, lc)
-        predictions = tf.squeeze(predictions)
-        
-        return predictions, lc
-        
+        predictions = model.reverse(z, lc, fused=fused)
+        predictions = tf.squeeze(predictions, axis=-1)
+        predictions = tf.cast(predictions, tf.float32, name='predictions')
+
+        return predictions, lc, z
+
+
+def load_frozen_graph(graph_path):
+    """Imports an inference graph written by export.py and returns the tensors of get_model."""
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(graph_path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+
+    tf.import_graph_def(graph_def, name='')
+    graph = tf.get_default_graph()
+    return (graph.get_tensor_by_name('vocoder/predictions:0'),
+            graph.get_tensor_by_name('vocoder/lc:0'),
+            graph.get_tensor_by_name('vocoder/z:0'))
+
+
+def _round_up(value, multiple):
+    return -(-value // multiple) * multiple
+
+
+def length_bucket(hparams):
+    """Multiple of frames the mels are padded to before synthesis.
+
+    With XLA every new input length is compiled again, so the lengths are rounded up to
+    hparams.xla_bucket_frames (and to frame_alignment) and the padding is cut off the output.
+    """
+    if not hparams.xla:
+        return 1
+    alignment = frame_alignment(hparams)
+    return hparams.xla_bucket_frames * alignment // gcd(hparams.xla_bucket_frames, alignment)
+
+
+def synthesize_padded(sess, predictions, lc_phr, z_phr, mel, z, hparams, bucket_frames):
+    """Synthesizes `mel` padded with zeros to a multiple of `bucket_frames`, with the noise `z`
+    (drawn by the graph if None), and returns the waveform of the unpadded frames."""
+    n_frames = mel.shape[0]
+    padding = _round_up(n_frames, bucket_frames) - n_frames
+
+    feed_dict = {lc_phr: np.pad(mel, [(0, padding), (0, 0)], 'constant')[np.newaxis]}
+    if z is not None:
+        feed_dict[z_phr] = np.pad(z, [(0, 0), (0, padding * hparams.hop_size), (0, 0)], 'constant')
+    return sess.run(predictions, feed_dict=feed_dict)[0, :n_frames * hparams.hop_size]
+
+
+def synthesize_chunked(sess, predictions, lc_phr, z_phr, mel, hparams, chunk_frames, bucket_frames=1):
+    """Yields the waveform of `mel` chunk by chunk.
+
+    Each chunk is synthesized from a window that extends it by the receptive field of
+    the model on both sides, and the context is trimmed off afterwards. The noise is
+    drawn once for the whole utterance, so the concatenated chunks match the one-shot
+    result while peak memory only depends on `chunk_frames`.
+    """
+    alignment = frame_alignment(hparams)
+    context = _round_up(receptive_field(hparams), alignment)
+    chunk_frames = _round_up(chunk_frames, alignment)
+
+    n_frames = mel.shape[0]
+    z = np.random.normal(size=[1, n_frames * hparams.hop_size, 1]).astype(np.float32) * hparams.temp
+
+    for start in range(0, n_frames, chunk_frames):
+        end = min(start + chunk_frames, n_frames)
+        window_start = max(start - context, 0)
+        window_end = min(end + context, n_frames)
+
+        result = synthesize_padded(sess, predictions, lc_phr, z_phr, mel[window_start:window_end],
+                                   z[:, window_start * hparams.hop_size:window_end * hparams.hop_size], hparams, bucket_frames)
+
+        offset = (start - window_start) * hparams.hop_size
+        yield result[offset:offset + (end - start) * hparams.hop_size]
+
+
+def write_chunks(path, chunks, sample_rate):
+    """Writes waveform chunks to a 16-bit PCM wav as soon as they are yielded, so the whole
+    waveform is never held in memory. Returns the number of samples written."""
+    n_samples = 0
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        for chunk in chunks:
+            f.writeframes((np.clip(chunk, -1., 1.) * 32767).astype('<i2').tobytes())
+            n_samples += len(chunk)
+    return n_samples
+
+
+def bucket_by_length(lengths, bucket_width, batch_size):
+    """Groups indices of `lengths` into batches of similar length.
+
+    Utterances are sorted by length and cut into buckets of `bucket_width` frames,
+    every bucket is then split into batches of at most `batch_size` items.
+    """
+    buckets = {}
+    for i in np.argsort(lengths, kind='mergesort'):
+        buckets.setdefault(lengths[i] // bucket_width, []).append(i)
+
+    batches = []
+    for key in sorted(buckets):
+        bucket = buckets[key]
+        batches.extend(bucket[i:i + batch_size] for i in range(0, len(bucket), batch_size))
+    return batches
+
+
+def synthesize_batch(sess, predictions, lc_phr, mels, hparams, bucket_frames=1):
+    """Synthesizes a list of mels with one sess.run, padding them to a common length."""
+    lengths = [mel.shape[0] for mel in mels]
+    max_len = _round_up(_round_up(max(lengths), bucket_frames), frame_alignment(hparams))
+
+    batch = np.zeros([len(mels), max_len, hparams.num_mels], dtype=np.float32)
+    for i, mel in enumerate(mels):
+        batch[i, :lengths[i]] = mel
+
+    result = sess.run(predictions, feed_dict={lc_phr: batch})
+    return [result[i, :length * hparams.hop_size] for i, length in enumerate(lengths)]
+
+
 def synthesize(args, hparams):
-    predictions, lc_phr = get_model(hparams)
-    
-    sess = tf.Session()
-    sess.run(tf.global_variables_initializer())
-    saver = tf.train.Saver()
-    try:
-        checkpoint_state = tf.train.get_checkpoint_state(args.saved_dir)
-
-        if (checkpoint_state and checkpoint_state.model_checkpoint_path):
-            print('Loading checkpoint {}'.format(checkpoint_state.model_checkpoint_path))
-            saver.restore(sess, checkpoint_state.model_checkpoint_path)
-
-    except tf.errors.OutOfRangeError as e:
-        print('Cannot restore checkpoint: {}'.format(e))
-        return
-    
-    mel_filenames = [f for f in os.listdir(args.mels_dir) if f.endswith('.npy')]
-    
-    for mel_filename in tqdm(mel_filenames):
-        mel_path = os.path.join(args.mels_dir, mel_filename)
-        mel = np.load(mel_path)[np.newaxis, ...]
-        
-        result = sess.run(predictions, feed_dict={lc_phr: mel})
-        audio_filename = mel_filename[:-4] + '.wav'
-        audio_path = os.path.join(args.output_dir, audio_filename)
-        librosa.output.write_wav(audio_path, result, sr=hparams.sample_rate)
-    
+    if args.frozen_graph:
+        print('Loading frozen graph {}'.format(args.frozen_graph))
+        predictions, lc_phr, z_phr = load_frozen_graph(args.frozen_graph)
+        sess = tf.Session(config=jit_config(hparams))
+    else:
+        predictions, lc_phr, z_phr = get_model(hparams, fused=args.fused)
+
+        sess = tf.Session(config=jit_config(hparams))
+        sess.run(tf.global_variables_initializer())
+        saver = tf.train.Saver()
+        try:
+            checkpoint_state = tf.train.get_checkpoint_state(args.saved_dir)
+
+            if (checkpoint_state and checkpoint_state.model_checkpoint_path):
+                print('Loading checkpoint {}'.format(checkpoint_state.model_checkpoint_path))
+                saver.restore(sess, checkpoint_state.model_checkpoint_path)
+
+        except tf.errors.OutOfRangeError as e:
+            print('Cannot restore checkpoint: {}'.format(e))
+            return
+
+    if args.wavs_dir:
+        # Resynthesis of wavs with the mels of the preprocessing front-end
+        mel_filenames = [f for f in os.listdir(args.wavs_dir) if f.endswith('.wav')]
+        mels = {}
+        for f in tqdm(mel_filenames):
+            wav = load_wav(os.path.join(args.wavs_dir, f), hparams.sample_rate)
+            wav = wav / np.abs(wav).max() * hparams.rescaling_max
+            mels[f] = melspectrogram(wav, hparams).astype(np.float32)
+        load_mel = mels.get
+        mel_length = lambda f: mels[f].shape[0]
+    else:
+        mel_filenames = [f for f in os.listdir(args.mels_dir) if f.endswith('.npy')]
+        load_mel = lambda f: np.load(os.path.join(args.mels_dir, f))
+        mel_length = lambda f: np.load(os.path.join(args.mels_dir, f), mmap_mode='r').shape[0]
+
+    def audio_path(mel_filename):
+        return os.path.join(args.output_dir, mel_filename[:-4] + '.wav')
+
+    def write_wav(mel_filename, result):
+        librosa.output.write_wav(audio_path(mel_filename), result, sr=hparams.sample_rate)
+
+    start_time = time.time()
+    n_samples = 0
+    bucket_frames = length_bucket(hparams)
+
+    if args.batch_size > 1:
+        lengths = [mel_length(f) for f in mel_filenames]
+        batches = bucket_by_length(lengths, args.bucket_width, args.batch_size)
+
+        for batch in tqdm(batches):
+            batch_mels = [load_mel(mel_filenames[i]) for i in batch]
+            results = synthesize_batch(sess, predictions, lc_phr, batch_mels, hparams, bucket_frames)
+            for i, result in zip(batch, results):
+                write_wav(mel_filenames[i], result)
+                n_samples += len(result)
+    else:
+        for mel_filename in tqdm(mel_filenames):
+            mel = load_mel(mel_filename)
+
+            if args.chunk_frames > 0:
+                # Chunks are appended to the file as they are synthesized
+                chunks = synthesize_chunked(sess, predictions, lc_phr, z_phr, mel, hparams, args.chunk_frames, bucket_frames)
+                n_samples += write_chunks(audio_path(mel_filename), chunks, hparams.sample_rate)
+            else:
+                result = synthesize_padded(sess, predictions, lc_phr, z_phr, mel, None, hparams, bucket_frames)
+                write_wav(mel_filename, result)
+                n_samples += len(result)
+
+    duration = time.time() - start_time
+    audio_duration = n_samples / hparams.sample_rate
+    print('Synthesized {} utterances ({:.2f} sec of audio) in {:.2f} sec: {:.2f} utterances/sec, RTF={:.3f}'.format(
+        len(mel_filenames), audio_duration, duration, len(mel_filenames) / duration, duration / max(audio_duration, 1e-8)))
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--saved_dir', default='logs/pretrained/', help='Folder with model checkpoint')
     parser.add_argument('--mels_dir', default='mels/', help='folder to contain mels to synthesize audio from using the model')
+    parser.add_argument('--wavs_dir', default='', help='Folder with wavs to resynthesize, used instead of --mels_dir')
     parser.add_argument('--output_dir', default='output/', help='folder to contain synthesized audio files')
-    
+    parser.add_argument('--frozen_graph', default='', help='Inference graph written by export.py, used instead of --saved_dir')
+    parser.add_argument('--fused', action='store_true', help='Merge ActNorm layers into the coupling networks')
+    parser.add_argument('--chunk_frames', type=int, default=0,
+        help='Synthesize long mels in chunks of this many frames, written to 16-bit wavs as they are done, to bound memory. 0 to disable')
+    parser.add_argument('--batch_size', type=int, default=1,
+        help='Number of mels of similar length synthesized in one batch')
+    parser.add_argument('--bucket_width', type=int, default=50,
+        help='Width in frames of the length buckets used for batching')
+
+    parser.add_argument('--xla', default=None, choices=['', 'global', 'flow'], help='Overrides hparams.xla')
+
     args = parser.parse_args()
-    
+    if args.batch_size > 1 and args.chunk_frames > 0:
+        parser.error('--chunk_frames can only be used with --batch_size=1')
+    if args.xla is not None:
+        hparams.set_hparam('xla', args.xla)
+
     os.makedirs(args.output_dir, exist_ok=True)
     synthesize(args, hparams)
-    
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,35 +1,58 @@
 import numpy as np 
 import os
+import glob
+import json
+import hashlib
 import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import time
 from sklearn.model_selection import train_test_split
 import tensorflow as tf 
 from tqdm import tqdm
+from audio import audio_with_context, stft_context, wav_bounds
 
 
 class TFRecordCreator:
-    def __init__(self, metadata_filename, hparams):
+    def __init__(self, metadata_filename, hparams, num_workers=None):
         self._hparams = hparams
         self._metadata_filename = metadata_filename
+        self._num_workers = num_workers or multiprocessing.cpu_count()
         self._pad = 0.
         self._basedir = os.path.dirname(metadata_filename)
         
-    def _get_example(self, audio, mel, speaker_id=None):
-        audio_list = tf.train.FloatList(value=audio)
+    def _get_example(self, audio, mel, speaker_id=None, bounds=None):
         audio_len_list = tf.train.Int64List(value=[np.int32(audio.shape[0])])
-        mel_shape_list = tf.train.Int64List(value=np.int32(mel.shape))
-        mel_list = tf.train.FloatList(value=mel.flatten())
 
         if speaker_id is not None:
             speaker_id_list =  tf.train.Int64List(value=[speaker_id])
 
         feature_key_value_pair = {
-            'audio': tf.train.Feature(float_list=audio_list),
             'audio_len': tf.train.Feature(int64_list=audio_len_list),
-            'mel_shape': tf.train.Feature(int64_list=mel_shape_list),
-            'mel': tf.train.Feature(float_list=mel_list),
         }
 
+        # Records for mel_on_the_fly only contain audio and where the wav lies in it
+        if mel is not None:
+            mel_shape_list = tf.train.Int64List(value=np.int32(mel.shape))
+            feature_key_value_pair['mel_shape'] = tf.train.Feature(int64_list=mel_shape_list)
+        if bounds is not None:
+            feature_key_value_pair['wav_bounds'] = tf.train.Feature(int64_list=tf.train.Int64List(value=list(bounds)))
+
+        if self._hparams.tfrecord_version >= 2:
+            # Raw little-endian bytes, parsed with decode_raw instead of a sparse FloatList
+            if self._hparams.tfrecord_pcm16:
+                audio_bytes = (np.clip(audio, -1., 1.) * 32767).astype('<i2').tobytes()
+            else:
+                audio_bytes = audio.astype('<f4').tobytes()
+
+            feature_key_value_pair['audio_raw'] = tf.train.Feature(bytes_list=tf.train.BytesList(value=[audio_bytes]))
+            feature_key_value_pair['audio_pcm16'] = tf.train.Feature(int64_list=tf.train.Int64List(value=[int(self._hparams.tfrecord_pcm16)]))
+            if mel is not None:
+                feature_key_value_pair['mel_raw'] = tf.train.Feature(bytes_list=tf.train.BytesList(value=[mel.astype('<f4').tobytes()]))
+        else:
+            feature_key_value_pair['audio'] = tf.train.Feature(float_list=tf.train.FloatList(value=audio))
+            if mel is not None:
+                feature_key_value_pair['mel'] = tf.train.Feature(float_list=tf.train.FloatList(value=mel.flatten()))
+
         if speaker_id is not None:
             feature_key_value_pair['speaker_id'] = tf.train.Feature(int64_list=speaker_id_list)
 
@@ -39,50 +62,183 @@ class TFRecordCreator:
 
 
     def _adjust_time_resolution(self, audio, mel, speaker_id=None):
-        if audio.shape[0] < self._hparams.max_time_steps:
-            audio_pad = self._hparams.max_time_steps - audio.shape[0]
-            mel_pad = audio_pad // self._hparams.hop_size
+        # Clips shorter than a training crop are zero padded to exactly one crop
+        max_time_frames = self._hparams.max_time_steps // self._hparams.hop_size
+        if self._hparams.mel_on_the_fly:
+            return audio_with_context(audio, self._hparams, max_time_frames), mel, speaker_id
+
+        n_frames = audio.shape[0] // self._hparams.hop_size
+        if n_frames < max_time_frames:
+            mel_pad = max_time_frames - n_frames
+            audio_pad = mel_pad * self._hparams.hop_size
             audio = np.pad(audio, (0, audio_pad), mode='constant', constant_values=self._pad)
-            mel = np.pad(mel, ((0, mel_pad), (0, 0)), mode='constant', constant_values=self._pad)
+            if mel is not None:
+                mel = np.pad(mel, ((0, mel_pad), (0, 0)), mode='constant', constant_values=self._pad)
         
-        self._assert_ready_for_upsample(audio, mel)
+        if mel is not None:
+            self._assert_ready_for_upsample(audio, mel)
         return audio, mel, speaker_id
 
 
+    def _split_chunks(self, audio, mel, bounds=None, chunk=True):
+        """Splits an utterance into (audio, mel, bounds) records of tfrecord_chunk_frames frames.
+
+        Consecutive chunks overlap by one training crop minus a frame, so every crop
+        of the utterance lies within some chunk and reading a record only decodes a
+        few crops worth of data instead of the whole utterance. With mel_on_the_fly
+        mel is None, every record carries its rows of audio_with_context including
+        the context of the STFT, and `bounds` (see audio.wav_bounds) are shifted to them.
+        """
+        max_time_frames = self._hparams.max_time_steps // self._hparams.hop_size
+        chunk_frames = max(self._hparams.tfrecord_chunk_frames, max_time_frames)
+        hop_size = self._hparams.hop_size
+
+        # Samples of STFT context around each record
+        context = 2 * stft_context(self._hparams) if self._hparams.mel_on_the_fly else 0
+        n_frames = (audio.shape[0] - context) // hop_size
+
+        if not chunk or self._hparams.tfrecord_chunk_frames <= 0 or n_frames <= chunk_frames:
+            return [(audio, mel, bounds)]
+
+        stride = chunk_frames - max_time_frames + 1
+        starts = list(range(0, n_frames - chunk_frames, stride)) + [n_frames - chunk_frames]
+        return [(audio[start * hop_size:(start + chunk_frames) * hop_size + context],
+                 None if mel is None else mel[start:start + chunk_frames],
+                 None if bounds is None else (bounds[0] - start * hop_size, bounds[1] - start * hop_size, bounds[2]))
+                for start in starts]
+
+
     def _assert_ready_for_upsample(self, x, c):
         assert len(x) % len(c) == 0 and len(x) // len(c) == self._hparams.hop_size
 
 
     def _py_load_sample(self, audio_filename, mel_filename, speaker_id):
-        mel = np.load(os.path.join(self._basedir, 'mels', mel_filename))
+        mel = None if self._hparams.mel_on_the_fly else np.load(os.path.join(self._basedir, 'mels', mel_filename))
         audio = np.load(os.path.join(self._basedir, 'audios', audio_filename))
         speaker_id = np.int32(speaker_id)
 
         return audio, mel, speaker_id
     
 
-    def _write_tfrecord(self, output_filename, meta):
-        with tf.python_io.TFRecordWriter(os.path.join(self._basedir, output_filename)) as tfwriter:
-            for m in tqdm(meta):
+    def _write_tfrecord(self, output_filename, meta, chunk=True):
+        # Written under a temporary name, an interrupted run never leaves a truncated shard behind
+        output_path = os.path.join(self._basedir, output_filename)
+        options = tf.python_io.TFRecordOptions(self._hparams.tfrecord_compression)
+        with tf.python_io.TFRecordWriter(output_path + '.tmp', options=options) as tfwriter:
+            for m in meta:
                 audio_filename, mel_filename, _, speaker_id, _ = m
                 audio, mel, speaker_id = self._py_load_sample(audio_filename, mel_filename, speaker_id)
-                if self._hparams.gin_channels > 0:
-                    example =self._get_example(audio, mel, speaker_id)
-                else:
-                    example = self._get_example(audio, mel)
-                tfwriter.write(example.SerializeToString())
+                bounds = wav_bounds(audio.shape[0], self._hparams) if self._hparams.mel_on_the_fly else None
+                audio, mel, speaker_id = self._adjust_time_resolution(audio, mel, speaker_id)
+                for audio_chunk, mel_chunk, chunk_bounds in self._split_chunks(audio, mel, bounds, chunk):
+                    if self._hparams.gin_channels > 0:
+                        example =self._get_example(audio_chunk, mel_chunk, speaker_id, chunk_bounds)
+                    else:
+                        example = self._get_example(audio_chunk, mel_chunk, bounds=chunk_bounds)
+                    tfwriter.write(example.SerializeToString())
+        os.replace(output_path + '.tmp', output_path)
+        return output_filename
+
+
+    def _shard_digest(self, meta, chunk):
+        """Hash of everything a shard is made of: its rows, the size and mtime of their .npy files
+        and the hparams of the record format."""
+        names = ['tfrecord_version', 'tfrecord_pcm16', 'tfrecord_chunk_frames', 'tfrecord_compression',
+                 'mel_on_the_fly', 'max_time_steps', 'hop_size', 'n_fft', 'gin_channels']
+        # Records for mel_on_the_fly used to carry two audio channels and no wav bounds
+        layout = ['wav_bounds'] if self._hparams.mel_on_the_fly else []
+        digest = hashlib.sha1(repr([self._hparams.get(name) for name in names] + [chunk] + layout).encode('utf-8'))
+        for m in meta:
+            digest.update('|'.join([str(x) for x in m]).encode('utf-8'))
+            paths = [os.path.join(self._basedir, 'audios', m[0])]
+            if not self._hparams.mel_on_the_fly:
+                paths.append(os.path.join(self._basedir, 'mels', m[1]))
+            for path in paths:
+                stat = os.stat(path)
+                digest.update(('%d|%d' % (stat.st_mtime_ns, stat.st_size)).encode('utf-8'))
+        return digest.hexdigest()
+
+
+    def _load_state(self):
+        path = os.path.join(self._basedir, 'tfrecords.json')
+        if not os.path.exists(path):
+            return {}
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+
+    def _save_state(self, state):
+        path = os.path.join(self._basedir, 'tfrecords.json')
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.replace(path + '.tmp', path)
+
+
+    def _write_shards(self, name, meta, num_shards, chunk=True):
+        """Writes `meta` into `num_shards` files named like train-00000-of-00032.tfrecord
+        using a pool of processes, one shard per task.
+
+        Utterances are assigned to shards by a hash of their file name, so the shards stay
+        the same when data is added. Shards whose digest matches the one recorded in
+        tfrecords.json are kept, an interrupted run continues with the missing shards.
+        """
+        num_shards = max(1, min(num_shards, len(meta)))
+        shards = [[] for _ in range(num_shards)]
+        for m in meta:
+            shards[int(hashlib.md5(str(m[0]).encode('utf-8')).hexdigest(), 16) % num_shards].append(m)
+
+        state = self._load_state()
+        filenames = ['%s-%05d-of-%05d.tfrecord' % (name, i, num_shards) for i in range(num_shards)]
+
+        # Shards of a previous run with another number of shards
+        for path in glob.glob(os.path.join(self._basedir, '%s-*-of-*.tfrecord' % name)):
+            if os.path.basename(path) not in filenames:
+                os.remove(path)
+                state.pop(os.path.basename(path), None)
+
+        executor = ProcessPoolExecutor(max_workers=self._num_workers)
+        futures = {}
+        for output_filename, shard_meta in zip(filenames, shards):
+            digest = self._shard_digest(shard_meta, chunk)
+            if state.get(output_filename) == digest and os.path.exists(os.path.join(self._basedir, output_filename)):
+                continue
+            futures[executor.submit(self._write_tfrecord, output_filename, shard_meta, chunk)] = digest
+
+        print('%s: %d of %d shards up to date' % (name, num_shards - len(futures), num_shards))
+        for future in tqdm(as_completed(futures), total=len(futures), desc=name):
+            state[future.result()] = futures[future]
+            self._save_state(state)
+        executor.shutdown()
+        return filenames
 
 
     def create_tfrecords(self):
         with open(self._metadata_filename, encoding='utf-8') as f:
             metadata = [line.strip().split('|') for line in f]
 
-        indices = np.arange(len(metadata))
-        train_indices, test_indices = train_test_split(indices,
-            test_size=self._hparams.test_size, random_state=self._hparams.split_random_state)
+        # The test set drawn by the first run is kept while its utterances exist, so that adding
+        # data does not move utterances between the sets and invalidate the shards
+        state = self._load_state()
+        audio_filenames = [m[0] for m in metadata]
+        test_set = set(state.get('test_set', []))
+        if test_set and test_set <= set(audio_filenames):
+            test_indices = np.array([i for i, f in enumerate(audio_filenames) if f in test_set])
+            train_indices = np.array([i for i, f in enumerate(audio_filenames) if f not in test_set])
+        else:
+            indices = np.arange(len(metadata))
+            train_indices, test_indices = train_test_split(indices,
+                test_size=self._hparams.test_size, random_state=self._hparams.split_random_state)
+            state['test_set'] = sorted(audio_filenames[i] for i in test_indices)
+            self._save_state(state)
 
         train_meta = list(np.array(metadata)[train_indices])
         test_meta = list(np.array(metadata)[test_indices])
 
-        self._write_tfrecord('train.tfrecord', train_meta)
-        self._write_tfrecord('test.tfrecord', test_meta)
\ No newline at end of file
+        # The test set gets shards in proportion to its size
+        test_shards = int(round(self._hparams.tfrecord_shards * len(test_meta) / float(len(metadata))))
+
+        start_time = time.time()
+        self._write_shards('train', train_meta, self._hparams.tfrecord_shards)
+        # Test utterances stay whole for the evaluation pass over the complete test set
+        self._write_shards('test', test_meta, test_shards, chunk=False)
+        print('Wrote %d utterances to tfrecords in %.2f sec' % (len(metadata), time.time() - start_time))
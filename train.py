@@ -3,13 +3,16 @@ os.environ["KMP_BLOCKTIME"] = "0"
 os.environ["KMP_AFFINITY"] = "granularity=fine,verbose,compact,1,0"
 
 import tensorflow as tf
+import sys
 import time
-from dataset import Dataset
+from dataset import Dataset, NumpyDataset
 from model import FloWaveNet
 from hparams import hparams
 import argparse
 import numpy as np
-from utils import fp16_dtype_getter, average_gradients
+from utils import fp16_dtype_getter, average_gradients, all_reduce_gradients, jit_config
+from audio import tf_melspectrogram, stft_context, audio_with_context, frame_padding
+from distributed import get_cluster, launch_local_cluster
   
     
 def get_optimizer(hparams, global_step):
@@ -24,24 +27,96 @@ def get_optimizer(hparams, global_step):
         return optimizer, learning_rate
         
         
+def get_loss_scale(hparams):
+    """Returns the loss scale and the counter of skipped steps (None for a fixed scale)."""
+    if not hparams.dynamic_loss_scale:
+        return tf.constant(hparams.scale), None
+
+    # Local variables are left out of the checkpoints, so checkpoints written with a fixed scale
+    # can be restored. A resumed run starts again from hparams.scale.
+    collections = [tf.GraphKeys.LOCAL_VARIABLES]
+    with tf.variable_scope('loss_scale'):
+        loss_scale = tf.get_variable('scale', initializer=float(hparams.scale), trainable=False, collections=collections)
+        tf.get_variable('good_steps', initializer=0, trainable=False, collections=collections)
+        skipped_steps = tf.get_variable('skipped_steps', initializer=0, trainable=False, collections=collections)
+        return loss_scale, skipped_steps
+
+
+def update_loss_scale(hparams, grads_finite):
+    """Halves the loss scale and counts a skipped step on overflow, doubles it after
+    hparams.loss_scale_window steps without one."""
+    with tf.variable_scope('loss_scale', reuse=True):
+        loss_scale = tf.get_variable('scale', dtype=tf.float32)
+        good_steps = tf.get_variable('good_steps', dtype=tf.int32)
+        skipped_steps = tf.get_variable('skipped_steps', dtype=tf.int32)
+
+    def finite():
+        grow = tf.greater_equal(good_steps + 1, hparams.loss_scale_window)
+        return tf.group(loss_scale.assign(tf.where(grow, loss_scale * 2., loss_scale)),
+                        good_steps.assign(tf.where(grow, 0, good_steps + 1)))
+
+    def overflow():
+        return tf.group(loss_scale.assign(tf.maximum(loss_scale / 2., 1.)),
+                        good_steps.assign(0),
+                        skipped_steps.assign_add(1))
+
+    with tf.name_scope('loss_scale_update'):
+        return tf.cond(grads_finite, true_fn=finite, false_fn=overflow)
+
+
 def clip_gradients(grad_vars):
     with tf.name_scope('gradient_clipping'):      
         grads, variables = zip(*grad_vars)
         clipped_grads, global_norm = tf.clip_by_global_norm(grads, 1)
         grad_vars = list(zip(clipped_grads, variables))        
         return grad_vars, global_norm
+
+
+def accumulate_gradients(grad_vars, accumulate_steps):
+    """Averages gradients over `accumulate_steps` micro-batches in non-trainable accumulators.
+
+    Returns the op adding the gradients of a micro-batch to the accumulators, the gradients
+    of the accumulators plus the current micro-batch for the optimizer step and the accumulators.
+    """
+    with tf.name_scope('gradient_accumulation'):
+        accumulate_ops = []
+        accumulated_grad_vars = []
+        accumulators = []
+        for g, v in grad_vars:
+            accumulator = tf.Variable(tf.zeros(v.shape, dtype=g.dtype), trainable=False,
+                                      collections=[tf.GraphKeys.LOCAL_VARIABLES], name='accumulator')
+            g = g / accumulate_steps
+            accumulate_ops.append(tf.assign_add(accumulator, g))
+            accumulated_grad_vars.append((accumulator + g, v))
+            accumulators.append(accumulator)
+
+        return tf.group(accumulate_ops), accumulated_grad_vars, accumulators
     
 
-def build_model(dataset, hparams, global_step, init):
+def build_model(dataset, hparams, global_step, init, loss_scale, cluster=None, task_index=0):
+    if hparams.pipeline_stages > 1:
+        if hparams.num_gpus > 1:
+            raise ValueError('pipeline_stages > 1 places a single tower on several gpus, set num_gpus = 1')
+        if hparams.batch_size % hparams.pipeline_micro_batches != 0:
+            raise ValueError('batch_size has to be a multiple of pipeline_micro_batches')
+
     tower_gradvars = []
     train_model = None
+    init_ops = []
     train_losses = []
     train_predictd_wavs = None
     train_target_wavs = None
     
-    consolidation_device  = '/cpu:0' if hparams.ps_device_type == 'CPU' and hparams.num_gpus > 1 else '/gpu:0'
+    worker = '/job:worker/task:%d' % task_index if cluster is not None else ''
+    if cluster is not None:
+        consolidation_device = worker
+    else:
+        consolidation_device  = '/cpu:0' if hparams.ps_device_type == 'CPU' and hparams.num_gpus > 1 else '/gpu:0'
     for i in range(hparams.num_gpus):
-        if hparams.num_gpus > 1:
+        if cluster is not None:
+            # Variables live on the parameter servers, every worker process runs its own towers
+            device_setter = tf.train.replica_device_setter(cluster=cluster, worker_device='%s/gpu:%d' % (worker, i))
+        elif hparams.num_gpus > 1:
             worker_device = '/gpu:%d' % i
             if hparams.ps_device_type == 'CPU':
                 device_setter = tf.train.replica_device_setter(ps_tasks=1, worker_device=worker_device, ps_device="/cpu:0")
@@ -54,15 +129,27 @@ def build_model(dataset, hparams, global_step, init):
             with tf.name_scope('tower_%d' % i) as name_scope:
                 with tf.device(device_setter):
                     model = FloWaveNet(hparams, init=init)
-                    log_p, logdet = model.forward(dataset.inputs[i], dataset.local_conditions[i], dataset.speaker_ids[i])
+                    if hparams.pipeline_stages > 1:
+                        stage_devices = ['%s/gpu:%d' % (worker, s) for s in range(hparams.pipeline_stages)]
+                        if cluster is not None:
+                            stage_devices = [tf.train.replica_device_setter(cluster=cluster, worker_device=d) for d in stage_devices]
+                        log_p, logdet = model.forward_pipelined(dataset.inputs[i], dataset.local_conditions[i], dataset.speaker_ids[i],
+                                                                stage_devices, hparams.pipeline_micro_batches)
+                        # The pipelined forward leaves the ActNorm initialization to a separate run
+                        with tf.name_scope('init'):
+                            init_ops.extend(model.init_pipelined(dataset.inputs[i], dataset.local_conditions[i], dataset.speaker_ids[i],
+                                                                 stage_devices, hparams.pipeline_micro_batches))
+                    else:
+                        log_p, logdet = model.forward(dataset.inputs[i], dataset.local_conditions[i], dataset.speaker_ids[i])
                     
                     with tf.name_scope('loss'):
                         loss = -(log_p + logdet)
                         
                     with tf.name_scope('gradients'):
                         variables = tf.trainable_variables()
-                        scaled_loss = tf.scalar_mul(hparams.scale, loss)
-                        grads = tf.gradients(scaled_loss, variables)
+                        scaled_loss = tf.scalar_mul(loss_scale, loss)
+                        # Keeps the backward pass of every pipeline stage on the device of the stage
+                        grads = tf.gradients(scaled_loss, variables, colocate_gradients_with_ops=hparams.pipeline_stages > 1)
                         grad_vars = list(zip(grads, variables)) 
                         tower_gradvars.append(grad_vars)
                    
@@ -73,47 +160,105 @@ def build_model(dataset, hparams, global_step, init):
 
     
     with tf.device(consolidation_device):
-        grad_vars = average_gradients(tower_gradvars)
-        grad_vars = [(tf.scalar_mul(1./hparams.scale, g), v) for g, v in grad_vars if g is not None]
+        if hparams.all_reduce and hparams.num_gpus > 1:
+            devices = ['%s/gpu:%d' % (worker, i) for i in range(hparams.num_gpus)]
+            grad_vars = all_reduce_gradients(tower_gradvars, devices, hparams.all_reduce, hparams.all_reduce_bucket_mb)
+        else:
+            grad_vars = average_gradients(tower_gradvars)
+        grad_vars = [(tf.scalar_mul(1./loss_scale, g), v) for g, v in grad_vars if g is not None]
+        if hparams.accumulate_steps > 1:
+            accumulate_op, grad_vars, accumulators = accumulate_gradients(grad_vars, hparams.accumulate_steps)
+        else:
+            accumulate_op = None
         clipped_grad_vars, grad_global_norm = clip_gradients(grad_vars)
         optimizer, lr = get_optimizer(hparams, global_step)    
+        if cluster is not None:
+            # Every update averages one batch of each worker
+            num_workers = cluster.num_tasks('worker')
+            optimizer = tf.train.SyncReplicasOptimizer(optimizer, replicas_to_aggregate=num_workers,
+                                                       total_num_replicas=num_workers)
         with tf.control_dependencies(update_ops):
-            train_op = optimizer.apply_gradients(clipped_grad_vars, global_step=global_step)
-
-    return train_op, train_model, train_losses, lr, grad_global_norm
+            if hparams.dynamic_loss_scale:
+                # Steps with inf/nan gradients are skipped instead of reaching Adam
+                grads_finite = tf.reduce_all([tf.reduce_all(tf.is_finite(g)) for g, _ in grad_vars])
+                apply_op = tf.cond(grads_finite,
+                                   true_fn=lambda: optimizer.apply_gradients(clipped_grad_vars, global_step=global_step),
+                                   false_fn=tf.no_op)
+                with tf.control_dependencies([apply_op]):
+                    train_op = update_loss_scale(hparams, grads_finite)
+            else:
+                train_op = optimizer.apply_gradients(clipped_grad_vars, global_step=global_step)
+
+        if accumulate_op is not None:
+            # The norm is kept for the summaries, evaluating the tensor later would only see the
+            # reset accumulators
+            last_global_norm = tf.Variable(0., trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                                           name='gradient_global_norm')
+            save_norm_op = last_global_norm.assign(grad_global_norm)
+            # The accumulators are only zeroed once the optimizer step and the norm have read them
+            with tf.control_dependencies([train_op, save_norm_op]):
+                train_op = tf.group([a.assign(tf.zeros_like(a)) for a in accumulators])
+            grad_global_norm = last_global_norm.read_value()
+
+    init_op = tf.group(init_ops) if init_ops else None
+    return train_op, accumulate_op, train_model, train_losses, lr, grad_global_norm, optimizer, init_op
 
 def get_test_losses(model, dataset, hparams):
+    """Loss over one pass of the test set, accumulated in the graph.
+
+    Every run of the update op adds an eval batch to the sums and the returned losses
+    are the means over all batches added since the reset op was run.
+    """
     log_p, logdet = model.forward(dataset.eval_inputs, dataset.eval_local_conditions, dataset.eval_speaker_ids)
     with tf.name_scope('loss'):
         loss = -(log_p + logdet)                
     
-    losses = [loss, log_p, logdet]
-    return losses
+    with tf.name_scope('test_losses'):
+        batch_size = tf.cast(tf.shape(dataset.eval_inputs)[0], tf.float32)
+        count = tf.Variable(0., trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name='count')
+        sums = [tf.Variable(0., trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name=name)
+                for name in ['total_loss', 'log_p', 'logdet']]
+
+        updates = [tf.assign_add(s, tf.cast(value, tf.float32) * batch_size) for s, value in zip(sums, [loss, log_p, logdet])]
+        update_op = tf.group(updates + [tf.assign_add(count, batch_size)])
+        reset_op = tf.variables_initializer(sums + [count])
+        losses = [s / tf.maximum(count, 1.) for s in sums]
+
+    return update_op, losses, reset_op
+
+def evaluate_test_losses(sess, dataset, update_op, losses, reset_op, max_batches=0):
+    """Runs the test losses over the test set, or over its first `max_batches` batches if > 0."""
+    dataset.initialize_eval(sess)
+    sess.run(reset_op)
+    batches = 0
+    while max_batches <= 0 or batches < max_batches:
+        try:
+            sess.run(update_op)
+            batches += 1
+        except tf.errors.OutOfRangeError:
+            break
+    return sess.run(losses)
+
+def get_test_summary(losses):
+    # Same tags as the training losses so that both curves share a plot in TensorBoard
+    names = ['losses/total_loss', 'losses/log_p', 'losses/logdet']
+    return tf.Summary(value=[tf.Summary.Value(tag=name, simple_value=value) for name, value in zip(names, losses)])
     
-def get_summary_op(train_losses, test_losses, learning_rate, grad_global_norm, is_training):
-    losses = tf.cond(is_training, true_fn=lambda: train_losses, false_fn=lambda: test_losses)
+def get_summary_op(train_losses, learning_rate, grad_global_norm, loss_scale, skipped_steps=None):
     train_summaries = []
-    test_summaries = []
-
-    total_loss = tf.summary.scalar('losses/total_loss', losses[0])
-    train_summaries.append(total_loss)
-    test_summaries.append(total_loss)
-
-    log_p = tf.summary.scalar('losses/log_p', losses[1])
-    train_summaries.append(log_p)
-    test_summaries.append(log_p)
 
-    logdet = tf.summary.scalar('losses/logdet', losses[2])
-    train_summaries.append(logdet)
-    test_summaries.append(logdet)
+    train_summaries.append(tf.summary.scalar('losses/total_loss', train_losses[0]))
+    train_summaries.append(tf.summary.scalar('losses/log_p', train_losses[1]))
+    train_summaries.append(tf.summary.scalar('losses/logdet', train_losses[2]))
 
     train_summaries.append(tf.summary.scalar('learning_rate', learning_rate))
     train_summaries.append(tf.summary.scalar('gradient_global_norm', grad_global_norm))
+    train_summaries.append(tf.summary.scalar('loss_scale', loss_scale))
+    if skipped_steps is not None:
+        train_summaries.append(tf.summary.scalar('skipped_steps', skipped_steps))
 
     train_op = tf.summary.merge(train_summaries)
-    test_op = tf.summary.merge(test_summaries)
-
-    return train_op, test_op
+    return train_op
 
 def predict_random_samples(model, metadata_path, hparams):
     basedir = os.path.dirname(metadata_path)
@@ -124,11 +269,20 @@ def predict_random_samples(model, metadata_path, hparams):
     max_time_frames = int(hparams.eval_max_time_steps // hparams.hop_size)
     random_index = np.random.choice(len(meta))
     sample = meta[random_index]
-    wav = np.load(os.path.join(basedir, 'audios', sample[0]))[:max_time_frames*hparams.hop_size]
-    lc = np.load(os.path.join(basedir, 'mels', sample[1]))[:max_time_frames]
+    if hparams.mel_on_the_fly:
+        # The stored wav is unpadded, the mel is computed like the input pipeline does
+        wav = np.load(os.path.join(basedir, 'audios', sample[0]))
+        audio = audio_with_context(wav, hparams)
+        n_frames = min(max_time_frames, (audio.shape[0] - 2 * stft_context(hparams)) // hparams.hop_size)
+        lc = tf_melspectrogram(tf.constant(audio[:(n_frames - 1) * hparams.hop_size + hparams.n_fft]), hparams)
+        lc = lc[tf.newaxis, ...]
+        wav = np.pad(wav, frame_padding(wav.shape[0], hparams), mode='constant')[:n_frames * hparams.hop_size]
+    else:
+        wav = np.load(os.path.join(basedir, 'audios', sample[0]))[:max_time_frames*hparams.hop_size]
+        lc = np.load(os.path.join(basedir, 'mels', sample[1]))[:max_time_frames]
+        lc = tf.convert_to_tensor(lc[np.newaxis, ...], dtype=tf.float32)
         
     target_wavs = tf.convert_to_tensor(wav[np.newaxis, :, np.newaxis], dtype=tf.float32)
-    lc = tf.convert_to_tensor(lc[np.newaxis, ...], dtype=tf.float32)
         
     z = tf.random_normal(target_wavs.shape) * hparams.temp
     speaker_ids = tf.constant([int(sample[3])], dtype=tf.int32)
@@ -162,10 +316,35 @@ def train(log_dir, args, hparams, input_path):
 
     checkpoint_path = os.path.join(save_dir, 'flowavenet_model.ckpt')
     input_path = os.path.join(args.base_dir, input_path)
-    train_tfrecord = os.path.join(args.base_dir, 'training_data/train.tfrecord')
-    test_tfrecord = os.path.join(args.base_dir, 'training_data/test.tfrecord')
+    # Only the shards written by TFRecordCreator, a train.tfrecord left from the single file layout would be read twice
+    train_tfrecord = os.path.join(args.base_dir, 'training_data/train-*-of-*.tfrecord')
+    test_tfrecord = os.path.join(args.base_dir, 'training_data/test-*-of-*.tfrecord')
     metadata_filename = os.path.join(args.base_dir, 'training_data/train.txt')
 
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    config.allow_soft_placement = True
+    # config.intra_op_parallelism_threads = 14
+    # config.inter_op_parallelism_threads = 4
+    config = jit_config(hparams, config)
+
+    cluster = None
+    task_index = 0
+    num_workers = 1
+    if args.job_name:
+        cluster = get_cluster(args.ps_hosts, args.worker_hosts)
+        server = tf.train.Server(cluster, job_name=args.job_name, task_index=args.task_index, config=config)
+        if args.job_name == 'ps':
+            server.join()
+            return save_dir
+
+        if hparams.dynamic_loss_scale:
+            raise ValueError('dynamic_loss_scale is not supported with distributed training, use a fixed scale')
+        task_index = args.task_index
+        num_workers = cluster.num_tasks('worker')
+        print('Worker {} of {}'.format(task_index, num_workers))
+    is_chief = task_index == 0
+
     print('Checkpoint_path: {}'.format(checkpoint_path))
     print('Loading training data from: {}'.format(input_path))
 
@@ -173,42 +352,80 @@ def train(log_dir, args, hparams, input_path):
     tf.set_random_seed(hparams.tf_random_seed)
 
     with tf.name_scope('dataset'):
-        dataset = Dataset(train_tfrecord, test_tfrecord, hparams)
+        if hparams.dataset_backend == 'numpy':
+            dataset = NumpyDataset(metadata_filename, hparams, num_shards=num_workers, shard_index=task_index)
+        else:
+            dataset = Dataset(train_tfrecord, test_tfrecord, hparams, num_shards=num_workers, shard_index=task_index)
 
     #Set up model
     init = tf.placeholder_with_default(False, shape=None, name='init')
-    global_step = tf.Variable(0, name='global_step', trainable=False)
-    train_op, model, train_losses, lr, grad_global_norm = build_model(dataset, hparams, global_step, init)
-    test_losses = get_test_losses(model, dataset, hparams)
-    
-    is_training = tf.placeholder(tf.bool, name='is_training')
+    with tf.device(tf.train.replica_device_setter(cluster=cluster) if cluster is not None else None):
+        global_step = tf.Variable(0, name='global_step', trainable=False)
+    loss_scale, skipped_steps = get_loss_scale(hparams)
+    train_op, accumulate_op, model, train_losses, lr, grad_global_norm, optimizer, init_op = build_model(
+        dataset, hparams, global_step, init, loss_scale, cluster, task_index)
+    test_update_op, test_losses, test_reset_op = get_test_losses(model, dataset, hparams)
     
-    train_summary_op, test_summary_op = get_summary_op(train_losses, test_losses, lr, grad_global_norm, is_training)
+    train_summary_op = get_summary_op(train_losses, lr, grad_global_norm, loss_scale, skipped_steps)
     eval_summary_op = get_eval_summary_op(model, metadata_filename, hparams)
 
     step = 0
     saver = tf.train.Saver(var_list=tf.global_variables())
+    samples_per_step = hparams.batch_size * hparams.num_gpus * hparams.accumulate_steps
 
     print('FloWaveNet training set to a maximum of {} steps'.format(args.train_steps))
-    
-    config = tf.ConfigProto()
-    config.gpu_options.allow_growth = True
-    config.allow_soft_placement = True
-    # config.intra_op_parallelism_threads = 14
-    # config.inter_op_parallelism_threads = 4
+
+    if cluster is None:
+        sess = tf.Session(config=config)
+    else:
+        # The chief initializes the variables on the parameter servers or restores them from
+        # save_dir and writes the checkpoints, the other workers wait for it
+        sess = tf.train.MonitoredTrainingSession(
+            master=server.target, is_chief=is_chief, checkpoint_dir=save_dir,
+            scaffold=tf.train.Scaffold(saver=saver), hooks=[optimizer.make_session_run_hook(is_chief)],
+            save_checkpoint_steps=args.checkpoint_interval, save_summaries_steps=None, save_summaries_secs=None,
+            log_step_count_steps=None, config=config)
+
+    # The synchronous workers wait for the chief while it evaluates, so it only evaluates a few batches
+    test_batches = args.test_batches
+    if test_batches is None:
+        test_batches = 10 if cluster is not None else 0
+
+    def init_actnorm():
+        print('Init ActNorm layer...', end='')
+        # Pipelined towers initialize ActNorm once on their first micro-batch, then take a normal step
+        if init_op is not None:
+            sess.run(init_op, feed_dict={init: True})
+        step, init_loss, _ = sess.run([global_step, train_losses[0], train_op], feed_dict={init: True})
+        print(" OK. Init loss: {:.5f}".format(init_loss))
+        return step
 
     #Train
-    with tf.Session(config=config) as sess:
-        train_writer = tf.summary.FileWriter(train_logdir, sess.graph)
-        test_writer = tf.summary.FileWriter(test_logdir)
-            
-        sess.run(tf.global_variables_initializer())
+    with sess:
+        if is_chief:
+            train_writer = tf.summary.FileWriter(train_logdir, tf.get_default_graph())
+            test_writer = tf.summary.FileWriter(test_logdir)
+
+        if cluster is None:
+            sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
         
         #initializing dataset        
         dataset.initialize(sess)
 
+        if cluster is not None:
+            step = sess.run(global_step)
+            # Only the chief initializes the ActNorm layers on the parameter servers from its batch,
+            # the first step of the other workers is a normal one
+            if step == 0 and is_chief:
+                step = init_actnorm()
+            # The other workers would compute their first gradients from uninitialized ActNorm
+            # layers, they start once the update of the chief's init step has been applied
+            while step == 0 and not is_chief:
+                time.sleep(1)
+                step = sess.run(global_step)
+
         #saved model restoring
-        if args.restore:
+        elif args.restore:
             # Restore saved model if the user requested it, default = True
             try:
                 checkpoint_state = tf.train.get_checkpoint_state(save_dir)
@@ -217,43 +434,55 @@ def train(log_dir, args, hparams, input_path):
                     print('Loading checkpoint {}'.format(checkpoint_state.model_checkpoint_path))
                     saver.restore(sess, checkpoint_state.model_checkpoint_path)
                 else:
-                    print('Init ActNorm layer...', end='')
-                    step, init_loss, _ = sess.run([global_step, train_losses[0], train_op], feed_dict={init: True})
-                    print(" OK. Init loss: {:.5f}".format(init_loss))
+                    step = init_actnorm()
 
             except tf.errors.OutOfRangeError as e:
                 print('Cannot restore checkpoint: {}'.format(e))
         else:
             print('Starting new training!')
-            print('Init ActNorm layer...', end='')
-            step, init_loss, _ = sess.run([global_step, train_losses[0], train_op], feed_dict={init: True})
-            print(" OK. Init loss: {:.5f}".format(init_loss))
+            step = init_actnorm()
 
+        interval_start_time, interval_start_step = time.time(), step
         
         # Training loop
         while step < args.train_steps:
             try:
                 start_time = time.time()
-                step, total_loss, log_p_loss, logdet_loss, opt = sess.run([global_step, train_losses[0], train_losses[1], train_losses[2], train_op])
+                # Every iteration is one optimizer step, the first accumulate_steps - 1 micro-batches
+                # only add their gradients
+                micro_batch_losses = [sess.run([train_losses, accumulate_op])[0] for _ in range(hparams.accumulate_steps - 1)]
+                step, last_losses, opt = sess.run([global_step, train_losses, train_op])
+                total_loss, log_p_loss, logdet_loss = np.mean(micro_batch_losses + [last_losses], axis=0)
                 step_duration = (time.time() - start_time)
-                message = 'Step {:7d} [{:.3f} sec/step, loss={:.5f}, log_p={:.5f}, logdet={:.5f}]'.format(step, step_duration, total_loss, log_p_loss, logdet_loss)
+                message = 'Step {:7d} [{:.3f} sec/step, {:.1f} samples/sec, loss={:.5f}, log_p={:.5f}, logdet={:.5f}]'.format(
+                    step, step_duration, samples_per_step / step_duration, total_loss, log_p_loss, logdet_loss)
                 print(message, end='\r')
             except tf.errors.InvalidArgumentError as e:
                 print(e)
                 print('Continue training')
-                                    
+
+            if not is_chief:
+                continue
 
             if step % args.summary_interval == 0:
                 print('\nWriting summary at step {}'.format(step))
-                train_writer.add_summary(sess.run(train_summary_op, feed_dict={is_training: True}), step)
-                test_writer.add_summary(sess.run(test_summary_op, feed_dict={is_training: False}), step)
+                # Every step of the global step is an update with one batch of each worker
+                samples_per_sec = (step - interval_start_step) * num_workers * samples_per_step / (time.time() - interval_start_time)
+                interval_start_time, interval_start_step = time.time(), step
+                print('{:.1f} samples/sec over {} workers'.format(samples_per_sec, num_workers))
+
+                train_writer.add_summary(sess.run(train_summary_op), step)
+                train_writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag='samples_per_sec', simple_value=samples_per_sec)]), step)
+                test_loss_values = evaluate_test_losses(sess, dataset, test_update_op, test_losses, test_reset_op, test_batches)
+                test_writer.add_summary(get_test_summary(test_loss_values), step)
                 
-            if step % args.checkpoint_interval == 0 or step == args.train_steps:
+            # Distributed checkpoints are written by the CheckpointSaverHook of the session
+            if cluster is None and (step % args.checkpoint_interval == 0 or step == args.train_steps):
                 saver.save(sess, checkpoint_path, global_step=global_step)
 
             if step % args.eval_interval == 0:
                 print('\nEvaluating at step {}'.format(step))
-                train_writer.add_summary(sess.run(eval_summary_op, feed_dict={is_training: True}), step)
+                train_writer.add_summary(sess.run(eval_summary_op), step)
                 train_writer.flush()
 
         return save_dir
@@ -271,8 +500,22 @@ def main():
     parser.add_argument('--eval_interval', type=int, default=5000,
         help='Steps between eval on test data')
     parser.add_argument('--train_steps', type=int, default=2000000, help='total number of model training steps')
+    parser.add_argument('--test_batches', type=int, default=None,
+        help='Test batches evaluated with every summary, 0 for the whole test set (default, 10 with distributed training)')
+    parser.add_argument('--ps_hosts', default='', help='Comma separated host:port list of the parameter servers')
+    parser.add_argument('--worker_hosts', default='', help='Comma separated host:port list of the workers')
+    parser.add_argument('--job_name', default='', help="'ps' or 'worker' for distributed training, the first worker is the chief")
+    parser.add_argument('--task_index', type=int, default=0, help='Index of this task within its job')
+    parser.add_argument('--xla', default=None, choices=['', 'global', 'flow'], help='Overrides hparams.xla')
+    parser.add_argument('--local_workers', type=int, default=0,
+        help='Run a parameter server and this many CPU-only workers as processes on this host')
     args = parser.parse_args()
 
+    if args.local_workers > 0:
+        sys.exit(launch_local_cluster(__file__, sys.argv[1:], args.local_workers))
+    if args.xla is not None:
+        hparams.set_hparam('xla', args.xla)
+
     logdir = os.path.join(args.base_dir, 'logs')
     os.makedirs(logdir, exist_ok=True)
     train(logdir, args, hparams, args.input)
@@ -1,4 +1,19 @@
+import os
 import tensorflow as tf
+from tensorflow.python.framework import function
+from tensorflow.python.framework import ops
+from tensorflow.python.util import nest
+
+def jit_config(hparams, config=None):
+    """Session config with XLA JIT compilation of the whole graph for hparams.xla == 'global'."""
+    config = config if config is not None else tf.ConfigProto()
+    if hparams.xla == 'global':
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+        # The global jit level only covers GPUs unless this flag is set before the first session
+        if '--tf_xla_cpu_global_jit' not in os.environ.get('TF_XLA_FLAGS', ''):
+            os.environ['TF_XLA_FLAGS'] = (os.environ.get('TF_XLA_FLAGS', '') + ' --tf_xla_cpu_global_jit').strip()
+    return config
+
 
 def fp16_dtype_getter(getter, name, shape=None, dtype=None, trainable=True, regularizer=None, *args, **kwargs):
     storage_dtype = tf.float32 if dtype in [tf.float32, tf.float16] else dtype
@@ -57,4 +72,81 @@ def average_gradients(tower_grads):
                 v = grad_and_vars[0][1]
                 grad_and_var = (grad, v)
                 average_grads.append(grad_and_var)
-        return average_grads
\ No newline at end of file
+        return average_grads
+
+
+def all_reduce_gradients(tower_grads, devices, algorithm='ring', bucket_size_mb=32):
+    """Averages the gradients of all towers with a few fused all-reduces.
+
+    The gradients of every tower are flattened and concatenated into buckets of about
+    `bucket_size_mb` MB, every bucket is all-reduced across `devices` with
+    tf.contrib.all_reduce ('ring', or 'hd' for recursive halving-doubling) and split
+    back into the shapes of the variables. Like average_gradients, the result is a list
+    of (gradient, variable) pairs with the variables of the first tower.
+    """
+    num_towers = len(tower_grads)
+    if algorithm == 'hd' and num_towers & (num_towers - 1) != 0:
+        raise ValueError('Recursive halving-doubling needs a power of 2 number of towers, got {}'.format(num_towers))
+    if algorithm not in ['ring', 'hd']:
+        raise ValueError('Unknown all-reduce algorithm {}'.format(algorithm))
+
+    indices = [i for i, (g, _) in enumerate(tower_grads[0]) if g is not None]
+    buckets = [[]]
+    bucket_bytes = 0
+    for i in indices:
+        size = tower_grads[0][i][1].shape.num_elements() * 4
+        if buckets[-1] and bucket_bytes + size > bucket_size_mb * 2 ** 20:
+            buckets.append([])
+            bucket_bytes = 0
+        buckets[-1].append(i)
+        bucket_bytes += size
+
+    with tf.name_scope('all_reduce'):
+        average_grads = []
+        for bucket in buckets:
+            if not bucket:
+                continue
+
+            flat_grads = []
+            for tower, device in enumerate(devices):
+                with tf.device(device):
+                    flat_grads.append(tf.concat([tf.reshape(tf.convert_to_tensor(tower_grads[tower][i][0]), [-1])
+                                                 for i in bucket], axis=0))
+
+            un_op = lambda x: x * (1. / num_towers)
+            if algorithm == 'ring':
+                reduced = tf.contrib.all_reduce.build_ring_all_reduce(flat_grads, 1, 1, list(range(num_towers)),
+                                                                      tf.add, un_op)
+            else:
+                reduced = tf.contrib.all_reduce.build_recursive_hd_all_reduce(flat_grads, tf.add, un_op)
+
+            variables = [tower_grads[0][i][1] for i in bucket]
+            grads = tf.split(reduced[0], [v.shape.num_elements() for v in variables])
+            average_grads.extend((tf.reshape(g, v.shape), v) for g, v in zip(grads, variables))
+        return average_grads
+
+
+def with_custom_gradient(inputs, variables, outputs, grad_fn):
+    """Passes `outputs` through an identity op whose gradient is computed by grad_fn.
+
+    grad_fn(inputs, outputs, grad_outputs) returns the gradients of `inputs` and of `variables`.
+    Nothing is backpropagated through the ops that computed `outputs`, so their intermediate
+    tensors are not kept for the backward pass.
+    """
+    inputs, variables, outputs = list(inputs), list(variables), list(outputs)
+    defun_inputs = [inputs, variables, outputs]
+
+    def custom_grad_fn(op, *grad_outputs):
+        fn_inputs, _, fn_outputs = nest.pack_sequence_as(defun_inputs, list(op.inputs))
+        grad_inputs, grad_vars = grad_fn(fn_inputs, fn_outputs, list(grad_outputs))
+        return tuple(list(grad_inputs) + list(grad_vars) + [None] * len(fn_outputs))
+
+    types = [t.dtype.base_dtype for t in nest.flatten(defun_inputs)]
+
+    @function.Defun(*types, func_name='identity_custom_grad_%d' % ops.uid(), python_grad_func=custom_grad_fn,
+                    shape_func=lambda _: [t.get_shape() for t in outputs])
+    def identity(*args):
+        _, _, fn_outputs = nest.pack_sequence_as(defun_inputs, list(args))
+        return tuple(tf.identity(t) for t in fn_outputs)
+
+    return list(identity(*nest.flatten(defun_inputs)))